@@ -0,0 +1,299 @@
+import argparse
+import importlib.util
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import wait
+
+import numpy as np
+from PIL import Image
+
+from color_engine import ColorMapping
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "multi-image color changer.py")
+
+
+def load_app_module():
+    # The app's file name has spaces in it, so it is loaded by path rather than imported
+    spec = importlib.util.spec_from_file_location("multi_image_color_changer", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TkStub:
+    # Stands in for Tk widgets: every method call is a no-op
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def __setitem__(self, key, value):
+        pass
+
+
+class TkModuleStub:
+    # Stands in for the tkinter module: every widget and constant is a TkStub, variables hold values
+    def __getattr__(self, name):
+        return TkStub
+
+
+class VarStub:
+    def __init__(self, master=None, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+TkModuleStub.IntVar = TkModuleStub.BooleanVar = VarStub
+
+
+class RootStub(TkStub):
+    # Collects after() callbacks so they can be run in place of the Tk main loop
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, delay, callback):
+        self.callbacks.append(callback)
+
+
+class ColorListStub(TkStub):
+    # Keeps ColorList's model building but skips rendering rows into a Listbox
+    def __init__(self, color_list):
+        self.color_list = color_list
+        self.top = 0
+        self.visible_rows = 10
+
+    def set_colors(self, colors, edited_colors):
+        self.color_list.set_colors(self, colors, edited_colors)
+
+    def render(self):
+        pass
+
+
+class PreviewCanvasStub(TkStub):
+    # Renders the viewport an unscrolled PreviewCanvas shows, without a Canvas
+    def __init__(self, module):
+        self.width, self.height = module.PREVIEW_SIZE
+        self.linked = []
+
+    def show(self, image_size, zoom, render_box):
+        render_box((0, 0, min(image_size[0], math.ceil(self.width / zoom)), min(image_size[1], math.ceil(self.height / zoom))))
+
+
+class PhotoImageStub:
+    def __init__(self, image):
+        self.image = image
+
+
+def stub_tk(module):
+    # Replace the Tk parts of the app module so ImageEditorApp runs without a display
+    module.tk = TkModuleStub()
+    module.ttk = TkModuleStub()
+    module.messagebox = TkStub()
+    module.Toplevel = lambda master: master  # Dialog callbacks are scheduled on the root
+    color_list = module.ColorList
+    module.ColorList = lambda master, width=40: ColorListStub(color_list)
+    module.PreviewCanvas = lambda master: PreviewCanvasStub(module)
+    module.ImageTk.PhotoImage = PhotoImageStub
+
+
+def make_headless_app(module, resize_factor, paths=()):
+    # Build an ImageEditorApp through its own __init__ with Tk stubbed, and add paths through Add Image
+    app = module.ImageEditorApp(RootStub())
+    app.result_cache = None  # Runs must not read or fill the user's result cache
+    app.resize_factor.set(resize_factor)
+    module.filedialog = type("FileDialogStub", (), {"askopenfilenames": staticmethod(lambda **kwargs: list(paths))})
+    app.add_image()
+    run_until_idle(app)
+    app.selected_image_index = 0
+    return app
+
+
+def run_until_idle(app):
+    # Do what the Tk main loop would: run after() callbacks until no job or dialog schedules more
+    while app.root.callbacks:
+        wait([job[0] for job in app.jobs.jobs.values()])
+        callbacks, app.root.callbacks = app.root.callbacks, []
+        for callback in callbacks:
+            callback()
+        if app.root.callbacks:
+            time.sleep(0.001)  # Saves in flight are polled, not waited on
+
+
+def generate_sheets(directory, count, size, colors, seed):
+    # Synthetic sprite sheets drawn from a shared palette, so mappings hit every sheet
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, size=(colors, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    paths = []
+    for index in range(count):
+        pixels = palette[rng.integers(0, colors, size=(size, size))]
+        path = os.path.join(directory, f"sheet_{index:04d}.png")
+        Image.fromarray(pixels, "RGBA").save(path)
+        paths.append(path)
+    return paths, [tuple(int(channel) for channel in color) for color in palette]
+
+
+def timed(repeat, setup, operation):
+    # Best wall time over several runs; setup is excluded from the measurement
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        operation(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_benchmarks(args):
+    module = load_app_module()
+    stub_tk(module)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, palette = generate_sheets(directory, args.images, args.size, args.colors, args.seed)
+        megapixels = args.images * args.size * args.size / 1e6
+
+        def record(name, seconds, amount, unit):
+            results[name] = {"seconds": seconds, "throughput": amount / seconds if seconds else float("inf"), "unit": unit}
+
+        def loaded_app(paths=paths):
+            return make_headless_app(module, args.resize_factor, paths)
+
+        def fresh_copies():
+            # Save All writes over its sources, so every run saves copies of them
+            copy_dir = tempfile.mkdtemp(dir=directory)
+            return [shutil.copy(path, copy_dir) for path in paths]
+
+        record("load", timed(args.repeat, lambda: None, lambda state: loaded_app()), args.images, "images/s")
+
+        # A mapping that swaps the first half of the palette, as Edit All Colors would build it
+        mapping = ColorMapping({palette[index]: palette[-index - 1] for index in range(len(palette) // 2)})
+
+        def applying(mapping):
+            # What Apply in Edit All Colors does with the mapping, until every render job is done.
+            # Each run gets its own copy, as the live mapping is a new one after every edit.
+            def apply(app):
+                app.apply_mapping_all(app.images, mapping.copy())
+                run_until_idle(app)
+            return apply
+
+        record("apply_color_changes", timed(args.repeat, loaded_app, applying(mapping)), megapixels, "megapixels/s")
+
+        # The same swaps, each also catching colors within a small distance of its source
+        tolerant_mapping = mapping.copy()
+        for color in mapping:
+            tolerant_mapping.set_tolerance(color, args.tolerance_distance)
+
+        record("apply_color_changes_tolerance", timed(args.repeat, loaded_app, applying(tolerant_mapping)), megapixels, "megapixels/s")
+
+        # Many small icons, remapped one by one and as a single batch
+        icon_dir = os.path.join(directory, "icons")
+        os.makedirs(icon_dir)
+        icon_paths, icon_palette = generate_sheets(icon_dir, args.icons, args.icon_size, args.colors, args.seed + 1)
+        icon_mapping = ColorMapping({icon_palette[index]: icon_palette[-index - 1] for index in range(len(icon_palette) // 2)})
+
+        def batching_app():
+            app = loaded_app(icon_paths)
+            app.batch_small_images.set(True)
+            return app
+
+        record("apply_color_changes_icons", timed(args.repeat, lambda: loaded_app(icon_paths), applying(icon_mapping)), args.icons, "images/s")
+        record("apply_color_changes_icons_batched", timed(args.repeat, batching_app, applying(icon_mapping)), args.icons, "images/s")
+
+        def unique_colors(app):
+            app.sorted_colors = None
+            app.get_all_unique_colors()
+
+        record("get_all_unique_colors", timed(args.repeat, loaded_app, unique_colors), args.images, "images/s")
+
+        record("update_colors_listbox", timed(args.repeat, loaded_app, lambda app: app.update_colors_listbox()), 1, "calls/s")
+
+        def previews(app):
+            for index in range(len(app.images)):
+                app.selected_image_index = index
+                app.update_previews()
+
+        def remapped_app(paths=paths):
+            app = loaded_app(paths)
+            applying(mapping)(app)
+            return app
+
+        def previewed_app():
+            app = remapped_app()
+            app.preview_cache.max_entries = 2 * len(app.images)
+            previews(app)
+            return app
+
+        record("update_previews", timed(args.repeat, remapped_app, previews), args.images, "images/s")
+        record("update_previews_cached", timed(args.repeat, previewed_app, previews), args.images, "images/s")
+
+        def save_all(app):
+            app.save_all_images()
+            run_until_idle(app)
+
+        record("save_all_images", timed(args.repeat, lambda: remapped_app(fresh_copies()), save_all), args.images, "images/s")
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Returns the names of benchmarks whose throughput dropped by more than tolerance
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["throughput"] / baseline[name]["throughput"]
+        marker = ""
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        print(f"{name:<34} {ratio:6.2f}x baseline{marker}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark remapping, color extraction, preview rendering and saving.")
+    parser.add_argument("--images", type=int, default=20, help="Number of synthetic sprite sheets")
+    parser.add_argument("--size", type=int, default=512, help="Width and height of each sheet in pixels")
+    parser.add_argument("--icons", type=int, default=1000, help="Number of small icons for the batching benchmarks")
+    parser.add_argument("--icon-size", type=int, default=32, help="Width and height of each icon in pixels")
+    parser.add_argument("--colors", type=int, default=64, help="Palette size of the sheets")
+    parser.add_argument("--resize-factor", type=int, default=4, help="Preview resize factor")
+    parser.add_argument("--tolerance-distance", type=int, default=8, help="Match tolerance used by the tolerance benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the best time is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="Compare against results stored in this JSON file")
+    parser.add_argument("--save-baseline", help="Store the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop against the baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+    for name, result in results.items():
+        print(f"{name:<34} {result['seconds'] * 1000:10.1f} ms {result['throughput']:12.2f} {result['unit']}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1728 @@
+import argparse
+import atexit
+import cProfile
+import functools
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+import numpy as np
+from PIL import Image
+
+# Pixels are handled as packed 32-bit integers. Reading RGBA bytes as little-endian
+# uint32 gives R in the low byte and A in the high byte, so pack_color must match.
+PIXEL_DTYPE = np.dtype("<u4")
+
+TRACE_ENV = "COLOR_CHANGER_TRACE"  # Write a Chrome trace of the session to this path
+CPROFILE_ENV = "COLOR_CHANGER_CPROFILE"  # Write a cProfile capture of the main thread to this path
+
+
+class Profiler:
+    # Records a timeline of operations with the pixels, images and cache hits/misses each one
+    # accounted for. Everything is a no-op until enable() is called.
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Per-thread stack of open spans
+        self.events = []
+        self.counters = Counter()
+        self.start = time.perf_counter()
+        self.trace_path = None
+        self.cprofile_path = None
+        self.cprofile = None
+
+    def enable(self, trace_path=None, cprofile_path=None):
+        self.enabled = True
+        self.trace_path = trace_path
+        self.cprofile_path = cprofile_path
+        if cprofile_path:
+            # cProfile only sees the thread that enabled it, which is the Tk thread for the app
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        atexit.register(self.dump)
+
+    def enable_from_env(self):
+        trace_path = os.environ.get(TRACE_ENV)
+        cprofile_path = os.environ.get(CPROFILE_ENV)
+        if trace_path or cprofile_path:
+            self.enable(trace_path, cprofile_path)
+
+    def span(self, name):
+        # Decorator timing every call of a function as one span of the timeline
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                stack = self.local.__dict__.setdefault("stack", [])
+                stack.append(Counter())
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    end = time.perf_counter()
+                    counts = stack.pop()
+                    with self.lock:
+                        self.events.append({
+                            "name": name,
+                            "ph": "X",
+                            "ts": (start - self.start) * 1e6,
+                            "dur": (end - start) * 1e6,
+                            "pid": os.getpid(),
+                            "tid": threading.get_ident(),
+                            "args": dict(counts),
+                        })
+            return wrapper
+        return decorator
+
+    def add(self, **counts):
+        # Attribute work such as pixels or images to the innermost open span of this thread
+        if not self.enabled:
+            return
+        stack = self.local.__dict__.get("stack")
+        if stack:
+            stack[-1].update(counts)
+        with self.lock:
+            self.counters.update(counts)
+
+    def hit(self, cache, hit):
+        self.add(**{f"{cache}_{'hits' if hit else 'misses'}": 1})
+
+    def dump(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            self.cprofile = None
+        if self.trace_path:
+            with self.lock:
+                trace = {"traceEvents": list(self.events), "otherData": {"counters": dict(self.counters)}}
+            with open(self.trace_path, "w") as f:
+                json.dump(trace, f)
+
+
+profiler = Profiler()
+
+
+def pack_color(color):
+    r, g, b, a = color
+    return r | (g << 8) | (b << 16) | (a << 24)
+
+
+def unpack_color(value):
+    value = int(value)
+    return (value & 0xFF, (value >> 8) & 0xFF, (value >> 16) & 0xFF, (value >> 24) & 0xFF)
+
+
+def pack_colors(colors):
+    # Sorted array of the distinct packed colors, as the result cache keeps the colors of an input
+    colors = list(colors)
+    return np.unique(np.fromiter((pack_color(color) for color in colors), dtype=PIXEL_DTYPE, count=len(colors)))
+
+
+def pack_pixels(image):
+    # Read-only view over the image bytes, one uint32 per pixel
+    return np.frombuffer(image.tobytes(), dtype=PIXEL_DTYPE)
+
+
+def image_from_pixels(pixels, size):
+    return Image.frombuffer("RGBA", size, pixels.astype(PIXEL_DTYPE, copy=False).tobytes(), "raw", "RGBA", 0, 1)
+
+
+class ColorMapping:
+    # {source_color: target_color} mapping stored as packed RGBA ints. A reverse index from
+    # target to sources makes source_for O(1), and the sorted key/value arrays consumed by
+    # the remap step are built once and cached until the mapping changes. Entries may carry
+    # a tolerance, in which case they also match colors within that distance of their source.
+    def __init__(self, mapping=None):
+        self.forward = {}  # Packed source -> packed target
+        self.reverse = {}  # Packed target -> set of packed sources
+        self.order = {}  # Packed source -> insertion number, so source_for matches dict iteration order
+        self.next_order = 0
+        self.tolerances = {}  # Packed source -> match distance, for entries that are not exact-only
+        self.arrays = None
+        self.restrictions = {}  # Color set -> restricted(), shared by images with the same colors
+        self.change_entries = None  # changes(), shared by every file a worker remaps
+        if mapping:
+            for color, new_color in mapping.items():
+                self[color] = new_color
+
+    def __getstate__(self):
+        # Workers get the entries only; the cached lookups can be tens of megabytes each
+        state = dict(self.__dict__)
+        state.update(arrays=None, restrictions={}, change_entries=None)
+        return state
+
+    def changed(self):
+        self.arrays = None
+        self.restrictions = {}
+        self.change_entries = None
+
+    def set_packed(self, source, target):
+        previous = self.forward.get(source)
+        if previous is not None:
+            self.reverse[previous].discard(source)
+            if not self.reverse[previous]:
+                del self.reverse[previous]
+        else:
+            self.order[source] = self.next_order
+            self.next_order += 1
+        self.forward[source] = target
+        self.reverse.setdefault(target, set()).add(source)
+        self.changed()
+
+    def __setitem__(self, color, new_color):
+        self.set_packed(pack_color(color), pack_color(new_color))
+
+    def __getitem__(self, color):
+        return unpack_color(self.forward[pack_color(color)])
+
+    def __delitem__(self, color):
+        source = pack_color(color)
+        target = self.forward.pop(source)
+        self.reverse[target].discard(source)
+        if not self.reverse[target]:
+            del self.reverse[target]
+        del self.order[source]
+        self.tolerances.pop(source, None)
+        self.changed()
+
+    def get(self, color, default=None):
+        target = self.forward.get(pack_color(color))
+        return default if target is None else unpack_color(target)
+
+    def __contains__(self, color):
+        return pack_color(color) in self.forward
+
+    def __len__(self):
+        return len(self.forward)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __eq__(self, other):
+        if not isinstance(other, ColorMapping):
+            other = ColorMapping(other)
+        return self.forward == other.forward and self.tolerances == other.tolerances
+
+    def set_tolerance(self, color, tolerance):
+        # Distance is the largest per-channel difference; 0 makes the entry exact-only again
+        source = pack_color(color)
+        if source not in self.forward:
+            raise KeyError(color)
+        if tolerance:
+            self.tolerances[source] = int(tolerance)
+        else:
+            self.tolerances.pop(source, None)
+        self.changed()
+
+    def tolerance(self, color):
+        return self.tolerances.get(pack_color(color), 0)
+
+    def signature(self):
+        # Hashable value equal for equal mappings, used to share renders between records
+        return frozenset(self.forward.items()), frozenset(self.tolerances.items())
+
+    def entry(self, color):
+        # (target, tolerance) of the entry for color, or None; set_entry() restores it
+        if color not in self:
+            return None
+        return self[color], self.tolerance(color)
+
+    def set_entry(self, color, entry):
+        if entry is None:
+            if color in self:
+                del self[color]
+            return
+        self[color] = entry[0]
+        self.set_tolerance(color, entry[1])
+
+    def keys(self):
+        return (unpack_color(source) for source in self.forward)
+
+    def values(self):
+        return (unpack_color(target) for target in self.forward.values())
+
+    def items(self):
+        return ((unpack_color(source), unpack_color(target)) for source, target in self.forward.items())
+
+    def source_for(self, new_color, default=None):
+        # Earliest added source color currently mapped to new_color
+        sources = self.reverse.get(pack_color(new_color))
+        if not sources:
+            return default
+        return unpack_color(min(sources, key=self.order.__getitem__))
+
+    def match(self, color, default=None):
+        # Target for a pixel of this color, taking tolerances into account
+        return self.matches([color], [default])[0]
+
+    def matches(self, colors, defaults=None):
+        # match() for many colors in one vectorized lookup; unmatched colors map to themselves
+        colors = list(colors)
+        defaults = colors if defaults is None else defaults
+        if not self.forward or not colors:
+            return list(defaults)
+        pixels = np.fromiter((pack_color(color) for color in colors), dtype=PIXEL_DTYPE, count=len(colors))
+        targets, hits = self.find_targets(pixels)
+        return [unpack_color(target) if hit else default for target, hit, default in zip(targets, hits, defaults)]
+
+    def find_targets(self, pixels):
+        # Packed target of each packed pixel, and which pixels some entry matches. A few colors are
+        # cheaper to compare against every tolerance entry than to build the 16M-cell tolerance
+        # table, which would then stay cached with the mapping.
+        if not self.forward:
+            return pixels.copy(), np.zeros(len(pixels), dtype=bool)
+        if not self.tolerances or self.arrays is not None or len(pixels) > RESOLVE_COLORS:
+            keys, values, table = self.lookup()
+            index, hits = find_hits(pixels, keys, table)
+            return values[index], hits
+
+        keys = np.fromiter(self.forward.keys(), dtype=PIXEL_DTYPE, count=len(self.forward))
+        values = np.fromiter(self.forward.values(), dtype=PIXEL_DTYPE, count=len(self.forward))
+        order = np.argsort(keys)
+        index, hits = find_hits(pixels, keys[order])
+        targets = values[order][index]
+        misses = np.flatnonzero(~hits)
+        if len(misses):
+            sources = sorted(self.tolerances, key=self.order.__getitem__)
+            channels = np.array([unpack_color(source) for source in sources], dtype=np.intp)
+            tolerances = np.array([self.tolerances[source] for source in sources], dtype=np.intp)
+            numbers = nearest_tolerance(pixels[misses], channels, tolerances)
+            found = numbers >= 0
+            sources = np.array(sources, dtype=PIXEL_DTYPE)
+            targets[misses[found]] = [self.forward[source] for source in sources[numbers[found]].tolist()]
+            hits[misses[found]] = True
+        return targets, hits
+
+    def changes(self):
+        # Copy without entries that leave every pixel as it is. The copy, and the lookup arrays it
+        # builds, are kept until the mapping changes, so it must not be modified.
+        if self.change_entries is None:
+            result = ColorMapping()
+            for source, target in self.forward.items():
+                if source != target or source in self.tolerances:
+                    result.set_packed(source, target)
+            result.tolerances = dict(self.tolerances)
+            self.change_entries = result
+        return self.change_entries
+
+    def restricted(self, colors):
+        # Entries whose source color is one of colors, walking whichever side is smaller. Tolerance
+        # entries are resolved against colors, so the result is an exact mapping covering every
+        # color that some entry matches. Results for frozensets of colors are kept until the mapping
+        # changes, so they must not be modified. colors may also be a sorted array of packed colors.
+        if isinstance(colors, np.ndarray):
+            return self.restricted_packed(colors)
+        if isinstance(colors, frozenset):
+            result = self.restrictions.get(colors)
+            if result is None:
+                result = self.restrictions[colors] = self.restricted(set(colors))
+            return result
+        if self.tolerances:
+            return self.resolved(colors)
+        result = ColorMapping()
+        if len(colors) < len(self.forward):
+            sources = (pack_color(color) for color in colors)
+            pairs = ((source, self.forward.get(source)) for source in sources)
+        else:
+            pairs = ((source, target) for source, target in self.forward.items() if unpack_color(source) in colors)
+        for source, target in sorted((pair for pair in pairs if pair[1] is not None), key=lambda pair: self.order[pair[0]]):
+            result.set_packed(source, target)
+        return result
+
+    def restricted_packed(self, colors):
+        result = ColorMapping()
+        if self.tolerances:
+            targets, hits = self.find_targets(colors)
+            for source, target in zip(colors[hits].tolist(), targets[hits].tolist()):
+                result.set_packed(source, target)
+            return result
+        sources = np.fromiter(self.forward.keys(), dtype=PIXEL_DTYPE, count=len(self.forward))
+        for source in sources[np.isin(sources, colors, assume_unique=True)].tolist():
+            result.set_packed(source, self.forward[source])
+        return result
+
+    def resolved(self, colors):
+        result = ColorMapping()
+        colors = list(colors)
+        for color, target in zip(colors, self.matches(colors, [None] * len(colors))):
+            if target is not None:
+                result[color] = target
+        return result
+
+    def copy(self):
+        result = ColorMapping()
+        for source, target in self.forward.items():
+            result.set_packed(source, target)
+        result.tolerances = dict(self.tolerances)
+        return result
+
+    def clear(self):
+        self.forward.clear()
+        self.reverse.clear()
+        self.order.clear()
+        self.tolerances.clear()
+        self.changed()
+
+    def lookup(self):
+        # Sorted (keys, values) arrays for searchsorted, as used by remap_pixels, plus the tolerance
+        # table (None for exact-only mappings). Targets of tolerance entries follow the sorted
+        # values, in the order the table numbers them.
+        if self.arrays is None:
+            keys = np.fromiter(self.forward.keys(), dtype=PIXEL_DTYPE, count=len(self.forward))
+            values = np.fromiter(self.forward.values(), dtype=PIXEL_DTYPE, count=len(self.forward))
+            order = np.argsort(keys)
+            keys, values, table = keys[order], values[order], None
+            if self.tolerances:
+                sources = sorted(self.tolerances, key=self.order.__getitem__)
+                targets = np.fromiter((self.forward[source] for source in sources), dtype=PIXEL_DTYPE, count=len(sources))
+                values = np.concatenate([values, targets])
+                table = build_tolerance_table(sources, [self.tolerances[source] for source in sources])
+            self.arrays = (keys, values, table)
+        return self.arrays
+
+
+def build_lookup(mapping):
+    # Turn a {source_color: target_color} mapping into sorted key/value arrays for searchsorted
+    # and its tolerance table
+    if not isinstance(mapping, ColorMapping):
+        mapping = ColorMapping(mapping)
+    return mapping.lookup()
+
+
+AMBIGUOUS = -2  # Tolerance table value for RGB cells within the tolerance of several entries
+
+
+def build_tolerance_table(sources, tolerances):
+    # Lookup table indexed by the packed RGB bits of a pixel, holding the number of the only source
+    # whose tolerance covers that RGB value, -1 for none, or AMBIGUOUS where several do. Only the cube
+    # around each source is filled in, so building the table costs O(sum of cube volumes). Pixels in
+    # a single-entry cell just have their alpha checked; only pixels in ambiguous cells are compared
+    # against every entry.
+    channels = np.array([unpack_color(source) for source in sources], dtype=np.intp)
+    tolerances = np.array(tolerances, dtype=np.intp)
+    low = np.clip(channels[:, :3] - tolerances[:, None], 0, 255)
+    high = np.clip(channels[:, :3] + tolerances[:, None], 0, 255)
+    table = np.full((256, 256, 256), -1, dtype=np.int16 if len(sources) < 2 ** 15 else np.int32)
+
+    for number in range(len(sources)):
+        # Axes run blue, green, red so the flattened index equals the packed RGB value
+        cube = table[tuple(slice(low[number][axis], high[number][axis] + 1) for axis in (2, 1, 0))]
+        cube[cube >= 0] = AMBIGUOUS
+        cube[cube == -1] = number
+
+    # Alpha range of each entry, with trailing empty ranges standing in for AMBIGUOUS and -1
+    alpha_low = np.append(np.clip(channels[:, 3] - tolerances, 0, 255), (1, 1)).astype(PIXEL_DTYPE)
+    alpha_high = np.append(np.clip(channels[:, 3] + tolerances, 0, 255), (0, 0)).astype(PIXEL_DTYPE)
+    return table.reshape(-1), alpha_low, alpha_high, channels, tolerances
+
+
+def nearest_tolerance(pixels, channels, tolerances):
+    # Number of the entry nearest to each pixel by largest per-channel difference, among the entries
+    # whose tolerance covers it, or -1; earlier entries win ties
+    colors = np.stack([(pixels >> shift) & 0xFF for shift in (0, 8, 16, 24)], axis=1).astype(np.intp)
+    numbers = np.full(len(pixels), -1, dtype=np.intp)
+    best = np.full(len(pixels), 256, dtype=np.intp)
+    for number in range(len(channels)):
+        distance = np.abs(colors - channels[number]).max(axis=1)
+        nearer = (distance <= tolerances[number]) & (distance < best)
+        numbers[nearer] = number
+        best[nearer] = distance[nearer]
+    return numbers
+
+
+def match_tolerance(pixels, table):
+    # Number of the tolerance entry matching each pixel, or -1
+    table, alpha_low, alpha_high, channels, tolerances = table
+    numbers = table[pixels & 0xFFFFFF].astype(np.intp)
+    alpha = pixels >> 24
+    matched = (alpha >= alpha_low[numbers]) & (alpha <= alpha_high[numbers])
+    result = np.where(matched, numbers, -1)
+    ambiguous = np.flatnonzero(numbers == AMBIGUOUS)
+    if len(ambiguous):
+        result[ambiguous] = nearest_tolerance(pixels[ambiguous], channels, tolerances)
+    return result
+
+
+def find_hits(pixels, keys, table=None):
+    # Position of each pixel in the lookup values, and which pixels actually match. Exact matches
+    # take priority; only the remaining pixels go through the tolerance table.
+    if len(keys) == 0:
+        return np.zeros(len(pixels), dtype=np.intp), np.zeros(len(pixels), dtype=bool)
+    index = np.searchsorted(keys, pixels)
+    index[index == len(keys)] = 0
+    hits = keys[index] == pixels
+    if table is not None:
+        misses = np.flatnonzero(~hits)
+        numbers = match_tolerance(pixels[misses], table)
+        found = numbers >= 0
+        matched = misses[found]
+        index[matched] = len(keys) + numbers[found]
+        hits[matched] = True
+    return index, hits
+
+
+def apply_hits(pixels, values, index, hits):
+    remapped = pixels.copy()
+    remapped[hits] = values[index[hits]]
+    return remapped
+
+
+def remap_pixels(pixels, keys, values, table=None):
+    # Each pixel is looked up once in the original mapping, exactly like the old per-pixel loop
+    if len(keys) == 0:
+        return pixels.copy()
+    index, hits = find_hits(pixels, keys, table)
+    return apply_hits(pixels, values, index, hits)
+
+
+RESOLVE_COLORS = 65536  # Tolerance entries are resolved per color for images with at most this many colors
+
+
+def resolve_tolerances(image, mapping):
+    # Sprite sheets have few colors, so tolerance entries are cheaper to resolve against the colors
+    # of the image once than to look up in the tolerance table for every pixel
+    if not isinstance(mapping, ColorMapping) or not mapping.tolerances:
+        return mapping
+    colors = image.getcolors(RESOLVE_COLORS)
+    if colors is None:
+        return mapping
+    return mapping.resolved(color for count, color in colors)
+
+
+@profiler.span("remap_image")
+def remap_image(image, mapping):
+    # Apply a {source_color: target_color} mapping to an RGBA image, returning a new image
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    profiler.add(pixels=image.width * image.height)
+    if not mapping:
+        return image.copy()
+    keys, values, table = build_lookup(resolve_tolerances(image, mapping))
+    return image_from_pixels(remap_pixels(pack_pixels(image), keys, values, table), image.size)
+
+
+BATCH_MAX_PIXELS = 128 * 128  # Images up to this size are remapped together in batching mode
+BATCH_FILES = 256  # Files handed to one worker at a time when the headless remap batches small files
+
+
+def is_batchable(image_size):
+    return image_size[0] * image_size[1] <= BATCH_MAX_PIXELS
+
+
+@profiler.span("remap_batch")
+def remap_batch(images, mapping):
+    # Remap many small RGBA images with a single lookup over their pixels laid end to end in one
+    # shared atlas buffer. The remapped images are views into one result buffer, so slicing them
+    # back out is zero-copy; images the mapping does not change are returned as they are.
+    if not images:
+        return []
+    sizes = [image.width * image.height for image in images]
+    atlas = np.empty(sum(sizes), dtype=PIXEL_DTYPE)
+    start = 0
+    for image, size in zip(images, sizes):
+        atlas[start:start + size] = pack_pixels(image)
+        start += size
+    profiler.add(pixels=len(atlas), images=len(images))
+
+    keys, values, table = build_lookup(mapping)
+    index, hits = find_hits(atlas, keys, table)
+    remapped = apply_hits(atlas, values, index, hits)
+
+    results = []
+    start = 0
+    for image, size in zip(images, sizes):
+        if hits[start:start + size].any():
+            image = Image.frombuffer("RGBA", image.size, remapped[start:start + size], "raw", "RGBA", 0, 1)
+        results.append(image)
+        start += size
+    return results
+
+
+def is_indexed(image):
+    # Palette images whose palette can be rewritten directly instead of their pixels
+    return image.mode == "P" and image.palette is not None and image.palette.mode in ("RGB", "RGBA")
+
+
+def palette_colors(image):
+    # RGBA color of every palette entry, with tRNS transparency applied exactly as convert("RGBA") does
+    count = len(image.getpalette()) // 3
+    strip = Image.frombytes("P", (count, 1), bytes(range(count)))
+    strip.putpalette(image.palette.tobytes(), image.palette.mode)
+    if "transparency" in image.info:
+        strip.info["transparency"] = image.info["transparency"]
+    return [unpack_color(value) for value in pack_pixels(strip.convert("RGBA"))]
+
+
+def open_image(path):
+    # Palette images stay indexed so remaps only rewrite the palette; everything else, including
+    # palette images with pixels outside their palette, is converted to RGBA
+    image = Image.open(path)
+    if is_indexed(image):
+        image.load()
+        if max(index for count, index in image.getcolors(256)) < len(image.getpalette()) // 3:
+            return image
+    return image.convert("RGBA")
+
+
+def image_histogram(image):
+    # List of (count, color) pairs covering every color in the image
+    if is_indexed(image):
+        # Count palette indices and merge entries that share a color
+        colors = palette_colors(image)
+        counts = {}
+        for count, index in image.getcolors(256):
+            counts[colors[index]] = counts.get(colors[index], 0) + count
+        return [(count, color) for color, count in counts.items()]
+    return image.getcolors(maxcolors=max(image.width * image.height, 1)) or []
+
+
+def remap_indexed(image, mapping):
+    # Apply a mapping to a palette image by rewriting its palette and tRNS alpha; O(palette size)
+    if not isinstance(mapping, ColorMapping):
+        mapping = ColorMapping(mapping)
+    remapped = image.copy()
+    remapped.putpalette(b"".join(bytes(color) for color in mapping.matches(palette_colors(image))), "RGBA")
+    remapped.info.pop("transparency", None)
+    return remapped
+
+
+@profiler.span("load_image")
+def load_image(path):
+    # Decode an image and build its histogram; safe to run on a background thread
+    image = open_image(path)
+    profiler.add(pixels=image.width * image.height, images=1)
+    return image, image_histogram(image)
+
+
+@profiler.span("save_image_file")
+def save_image_file(image, path):
+    # Encode and write an image; safe to run on a background thread
+    profiler.add(pixels=image.width * image.height, images=1)
+    break_hard_link(path)
+    image.save(path)
+
+
+def break_hard_link(path):
+    # Outputs may be hard links into the result cache; never write through one in place
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        os.unlink(path)
+
+
+def remap_histogram(histogram, mapping):
+    # Histogram of remap_image(image, mapping), derived from the histogram of image without touching pixels
+    if not isinstance(mapping, ColorMapping):
+        mapping = ColorMapping(mapping)
+    counts = {}
+    for (count, color), new_color in zip(histogram, mapping.matches(color for count, color in histogram)):
+        counts[new_color] = counts.get(new_color, 0) + count
+    return [(count, color) for color, count in counts.items()]
+
+
+TILE_ROWS = 256  # Rows per strip in tiled processing
+TILED_PIXELS = 4096 * 4096  # RGBA images at least this large are remapped and saved in strips
+
+
+def iter_strips(image, rows=TILE_ROWS):
+    # Packed pixels of consecutive horizontal strips; only one strip is copied out at a time
+    for top in range(0, image.height, rows):
+        yield pack_pixels(image.crop((0, top, image.width, min(top + rows, image.height))))
+
+
+def remap_strips(image, mapping, rows=TILE_ROWS):
+    keys, values, table = build_lookup(mapping)
+    for pixels in iter_strips(image, rows):
+        yield remap_pixels(pixels, keys, values, table)
+
+
+def has_hits(image, mapping, rows=TILE_ROWS):
+    # Whether the mapping changes any pixel, checked strip by strip
+    keys, values, table = build_lookup(mapping)
+    return any(find_hits(pixels, keys, table)[1].any() for pixels in iter_strips(image, rows))
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_STREAM_MODES = {2: "RGB", 6: "RGBA"}  # PNG color types read_png_strips() can stream
+
+
+def iter_png_chunks(f):
+    # (type, data) of each chunk of a PNG file read past its signature
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = f.read(length)
+        f.read(4)  # CRC
+        yield chunk_type, data
+        if chunk_type == b"IEND":
+            return
+
+
+def png_stream_header(path):
+    # (width, height, mode) of a PNG that read_png_strips() can stream: 8-bit RGB or RGBA, not
+    # interlaced and without tRNS transparency. None for any other file.
+    try:
+        with open(path, "rb") as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return None
+            chunks = iter_png_chunks(f)
+            chunk_type, data = next(chunks, (None, b""))
+            if chunk_type != b"IHDR" or len(data) != 13:
+                return None
+            width, height, depth, color_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", data)
+            if depth != 8 or color_type not in PNG_STREAM_MODES or interlace:
+                return None
+            for chunk_type, data in chunks:
+                if chunk_type == b"tRNS":
+                    return None
+                if chunk_type == b"IDAT":
+                    return width, height, PNG_STREAM_MODES[color_type]
+    except OSError:
+        pass
+    return None
+
+
+def read_png_strips(path, rows=TILE_ROWS):
+    # Packed RGBA pixels of consecutive strips of a PNG accepted by png_stream_header(), which are
+    # decompressed and unfiltered one strip at a time. Filters refer to the row above, so each strip
+    # is decoded behind an unfiltered copy of the last row of the strip before it.
+    width, height, mode = png_stream_header(path)
+    stride = width * len(mode)
+    decompressor = zlib.decompressobj()
+    above = bytes(stride + 1)  # The row above the first row is all zeros
+    pending = bytearray()
+    remaining = height
+
+    def decode(count):
+        nonlocal above, pending
+        size = count * (stride + 1)
+        data = zlib.compress(above + pending[:size], 0)
+        del pending[:size]
+        strip = Image.frombytes(mode, (width, count + 1), data, "zip", mode)
+        above = b"\x00" + strip.crop((0, count, width, count + 1)).tobytes()
+        if mode != "RGBA":
+            strip = strip.convert("RGBA")
+        return pack_pixels(strip)[width:]
+
+    with open(path, "rb") as f:
+        f.read(8)
+        for chunk_type, data in iter_png_chunks(f):
+            if chunk_type != b"IDAT":
+                continue
+            pending += decompressor.decompress(data)
+            while remaining and len(pending) >= min(rows, remaining) * (stride + 1):
+                count = min(rows, remaining)
+                remaining -= count
+                yield decode(count)
+    pending += decompressor.flush()
+    if remaining:
+        if len(pending) < remaining * (stride + 1):
+            raise ValueError(f"{path}: image data is truncated")
+        yield decode(remaining)
+
+
+def write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+
+def write_png_strips(path, size, strips):
+    # Stream packed RGBA strips into an 8-bit RGBA PNG without holding the whole image.
+    # Each row uses whichever of the None, Sub and Up filters has the smallest absolute sum.
+    width, height = size
+    compressor = zlib.compressobj(6)
+    previous = np.zeros(width * 4, dtype=np.uint8)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        write_png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        for pixels in strips:
+            rows = pixels.astype(PIXEL_DTYPE, copy=False).view(np.uint8).reshape(-1, width * 4)
+            sub = rows.copy()
+            sub[:, 4:] -= rows[:, :-4]
+            up = rows - np.vstack((previous, rows[:-1]))
+            candidates = np.stack((rows, sub, up))
+            # abs() of -128 wraps to -128, which reads back as 128 through the uint8 view
+            scores = np.abs(candidates.view(np.int8)).view(np.uint8).sum(axis=2, dtype=np.uint32)
+            filters = scores.argmin(axis=0)
+            filtered = np.empty((len(rows), width * 4 + 1), dtype=np.uint8)
+            filtered[:, 0] = np.array((0, 1, 2), dtype=np.uint8)[filters]
+            filtered[:, 1:] = candidates[filters, np.arange(len(rows))]
+            previous = rows[-1]
+
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                write_png_chunk(f, b"IDAT", data)
+        write_png_chunk(f, b"IDAT", compressor.flush())
+        write_png_chunk(f, b"IEND", b"")
+
+
+@profiler.span("save_remapped_tiled")
+def save_remapped_tiled(image, mapping, path, rows=TILE_ROWS):
+    # Remap and encode an RGBA image strip by strip, so the remapped copy never exists in full.
+    # The pixels written are identical to remap_image(image, mapping).
+    profiler.add(pixels=image.width * image.height, images=1)
+    break_hard_link(path)
+    write_png_strips(path, image.size, remap_strips(image, mapping, rows))
+
+
+@profiler.span("remap_file_tiled")
+def remap_file_tiled(source_path, output_path, mapping, rows=TILE_ROWS):
+    # Read, remap and encode a streamable PNG strip by strip, so neither the source nor the remapped
+    # image is ever held in full. Returns the same status as remap_file_uncached().
+    width, height = png_stream_header(source_path)[:2]
+    profiler.add(pixels=width * height, images=1)
+    keys, values, table = build_lookup(mapping)
+    changed = False
+
+    def remapped():
+        nonlocal changed
+        for pixels in read_png_strips(source_path, rows):
+            index, hits = find_hits(pixels, keys, table)
+            changed = changed or bool(hits.any())
+            yield apply_hits(pixels, values, index, hits)
+
+    # Written beside the output and moved into place, which also never writes through a hard link
+    temporary_path = output_path + ".tmp"
+    try:
+        write_png_strips(temporary_path, (width, height), remapped())
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    if not changed:
+        os.remove(temporary_path)
+        return copy_unchanged(source_path, output_path)
+    os.replace(temporary_path, output_path)
+    return "written"
+
+
+def use_tiled_save(image_size, path):
+    return image_size[0] * image_size[1] >= TILED_PIXELS and os.path.splitext(path)[1].lower() == ".png"
+
+
+LOSSLESS_EXTENSIONS = (".png", ".tif", ".tiff")
+
+
+def is_lossless_path(path):
+    # Formats that store RGBA pixels exactly, so a saved buffer is identical to the file on disk
+    return os.path.splitext(path)[1].lower() in LOSSLESS_EXTENSIONS
+
+
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024  # Bytes of decoded pixel data kept in memory
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageStore:
+    # Holds decoded pixel buffers for image records in an LRU bounded by a memory budget.
+    # Records only keep metadata: evicted originals are decoded again from record["path"]
+    # and evicted edited images are regenerated from record["mapping"]. Buffers belong to
+    # contents rather than records, so records loaded from byte-identical files share one
+    # decoded image, one histogram and one render per mapping. While a record's mapping is
+    # empty its edited image is the original buffer itself, so callers must never modify
+    # returned images in place. Buffer access is locked so background jobs can call load(),
+    # original() and render() while the UI thread owns the records. Palette images also keep
+    # their indexed source, which is what gets remapped and saved.
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.lock = threading.RLock()
+        self.buffers = OrderedDict()  # (content key, "indexed"/"original") or (content key, "edited", mapping key) -> image
+        self.memory_used = 0
+        self.next_key = 0
+        self.next_version = 0  # Bumped whenever an original image or a mapping changes
+        self.contents = {}  # File digest -> content shared by the records loaded from that file content
+        self.running = {}  # Key of work started through once() -> event set when it finishes
+
+    def new_key(self):
+        with self.lock:
+            self.next_key += 1
+            return self.next_key
+
+    def bump_version(self, record):
+        self.next_version += 1
+        record["version"] = self.next_version
+
+    def put(self, entry, image):
+        with self.lock:
+            self.drop(entry)
+            self.buffers[entry] = image
+            self.memory_used += image_nbytes(image)
+
+            # Evict least recently used buffers, but never the one just stored
+            while self.memory_used > self.memory_budget and len(self.buffers) > 1:
+                oldest = next(iter(self.buffers))
+                if oldest == entry:
+                    break
+                self.drop(oldest)
+
+    def get(self, entry):
+        with self.lock:
+            image = self.buffers.get(entry)
+            if image is not None:
+                self.buffers.move_to_end(entry)
+        profiler.hit("image_store", image is not None)
+        return image
+
+    def drop(self, entry):
+        with self.lock:
+            image = self.buffers.pop(entry, None)
+            if image is not None:
+                self.memory_used -= image_nbytes(image)
+
+    def once(self, key, work):
+        # Run work unless a call with the same key is already running, in which case wait for
+        # that call to finish and return None; callers then find its result in the buffers
+        with self.lock:
+            done = self.running.get(key)
+            if done is None:
+                done = self.running[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            done.wait()
+            return None
+        try:
+            return work()
+        finally:
+            with self.lock:
+                del self.running[key]
+            done.set()
+
+    def load(self, path, digest):
+        # (image, histogram) of a file, decoding each distinct file content once. Files whose
+        # content is already loaded return image None; their records share the decoded buffers.
+        while True:
+            with self.lock:
+                content = self.contents.get(digest)
+            if content is not None:
+                profiler.add(duplicate_images=1)
+                return None, content["histogram"]
+            result = self.once(("load", digest), lambda: self.load_content(path, digest))
+            if result is not None:
+                return result
+
+    def load_content(self, path, digest):
+        image, histogram = load_image(path)
+        with self.lock:
+            content = self.acquire(digest)
+            content["refs"] -= 1  # Held by records only once they are given this content in set_original
+            self.describe(content, image, histogram)
+        return image, histogram
+
+    def acquire(self, digest):
+        # Content for a file digest, created if needed; a digest of None always gets a new content
+        with self.lock:
+            content = self.contents.get(digest) if digest is not None else None
+            if content is None:
+                content = {"key": self.new_key(), "digest": digest, "refs": 0, "size": None, "indexed": False, "histogram": None}
+                if digest is not None:
+                    self.contents[digest] = content
+            content["refs"] += 1
+            return content
+
+    def release(self, record):
+        # Buffers of a content are dropped with the last record that uses it
+        content = record.pop("content", None)
+        if content is None:
+            return
+        with self.lock:
+            content["refs"] -= 1
+            if content["refs"] > 0:
+                return
+            if self.contents.get(content["digest"]) is content:
+                del self.contents[content["digest"]]
+            for entry in [entry for entry in self.buffers if entry[0] == content["key"]]:
+                self.drop(entry)
+
+    def describe(self, content, image, histogram):
+        content["size"] = image.size
+        content["indexed"] = is_indexed(image)
+        if histogram is not None:
+            content["histogram"] = histogram
+        self.put((content["key"], "indexed" if content["indexed"] else "original"), image)
+
+    def indexed(self, record):
+        # Palette source of an indexed record
+        entry = (record["content"]["key"], "indexed")
+        image = self.get(entry)
+        if image is None:
+            # Decode outside the lock so other buffers stay available meanwhile
+            image = Image.open(record["path"])
+            image.load()
+            self.put(entry, image)
+        return image
+
+    def original(self, record):
+        entry = (record["content"]["key"], "original")
+        image = self.get(entry)
+        if image is None:
+            if record.get("indexed"):
+                image = self.indexed(record).convert("RGBA")
+            else:
+                image = Image.open(record["path"]).convert("RGBA")
+            self.put(entry, image)
+        return image
+
+    def edited(self, record):
+        if not record["mapping"]:
+            return self.original(record)
+        return self.render(record, record["mapping"])
+
+    def output(self, record):
+        # Image to write when saving: palette images stay indexed so file sizes don't grow
+        if record.get("indexed"):
+            if not record["mapping"]:
+                return self.indexed(record)
+            return remap_indexed(self.indexed(record), record["mapping"])
+        return self.edited(record)
+
+    def set_original(self, record, image, histogram=None, digest=None):
+        # With image None the file at record["path"] is the new original and is decoded on demand,
+        # unless a record with the same digest already shares its decoded content. A record that
+        # load() found a duplicate for has no size of its own; if that content has been released
+        # since, the file is decoded again.
+        self.release(record)
+        content = self.acquire(digest)
+        if image is None and content["size"] is None and record.get("size") is None:
+            image = load_image(record["path"])[0]
+        with self.lock:
+            if image is not None:
+                self.describe(content, image, histogram)
+            elif content["size"] is None:
+                content["size"] = record.get("size")
+                content["histogram"] = histogram
+        record["content"] = content
+        record["size"] = content["size"]
+        record["indexed"] = content["indexed"]
+        record["mapping"] = ColorMapping()
+        self.bump_version(record)
+        record["original_version"] = record["version"]
+
+    def set_mapping(self, record, mapping):
+        # Only keep the entries that hit colors in this image. The edited pixels are regenerated
+        # lazily; returns whether the mapping changed at all.
+        if not isinstance(mapping, ColorMapping):
+            mapping = ColorMapping(mapping)
+        color_index = record.get("color_index")
+        mapping = mapping.restricted(color_index) if color_index is not None else mapping.copy()
+        if mapping == record["mapping"]:
+            return False
+        record["mapping"] = mapping
+        self.bump_version(record)
+        return True
+
+    def apply_mapping(self, record, mapping):
+        # Pixels are materialized only if the mapping hits the image
+        if self.set_mapping(record, mapping) and record["mapping"]:
+            self.render(record, record["mapping"])
+
+    def render(self, record, mapping):
+        # RGBA edited image for the mapping, rendered once per content and mapping and kept in the
+        # buffers; safe to call from a background thread
+        entry = (record["content"]["key"], "edited", mapping.signature())
+        while True:
+            image = self.get(entry)
+            if image is not None:
+                return image
+            image = self.once(entry, lambda: self.render_content(entry, record, mapping))
+            if image is not None:
+                return image
+
+    def render_batch(self, records, mapping):
+        # Render small RGBA records with one remap_batch() over all their pixels. records holds
+        # (record, version, record mapping) taken when the batch was started; every record mapping
+        # is mapping restricted to the colors of its image, so the pixels are the same. Records
+        # changed since then, already rendered, or sharing content with an earlier record are skipped.
+        batch = {}
+        for record, version, record_mapping in records:
+            entry = (record["content"]["key"], "edited", record_mapping.signature())
+            if record.get("version") == version and entry not in batch and self.get(entry) is None:
+                batch[entry] = record
+        originals = [self.original(record) for record in batch.values()]
+        for entry, image in zip(batch, remap_batch(originals, mapping)):
+            # remap_batch() returns views into one shared buffer, which would stay alive until every
+            # view was evicted; separate copies keep the memory budget accurate
+            self.put(entry, image.copy())
+
+    def render_content(self, entry, record, mapping):
+        if record.get("indexed"):
+            image = remap_indexed(self.indexed(record), mapping).convert("RGBA")
+        else:
+            image = remap_image(self.original(record), mapping)
+        self.put(entry, image)
+        return image
+
+    def is_dirty(self, record):
+        # apply_mapping only keeps entries that hit the image, so any mapping means changed pixels
+        return bool(record["mapping"].changes())
+
+    def reset(self, record):
+        # The edited image is the original again until a new mapping is set. An empty mapping is
+        # kept as it is, so callers can tell that nothing changed.
+        if record["mapping"]:
+            self.bump_version(record)
+            record["mapping"] = ColorMapping()
+
+    def discard(self, record):
+        self.bump_version(record)  # Renders still in flight for this record are ignored
+        self.release(record)
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
+            self.memory_used = 0
+            self.contents.clear()
+
+
+CACHE_DIR_ENV = "COLOR_CHANGER_CACHE_DIR"
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+CACHE_VERSION = 2  # Bump when output encoding changes so old entries stop matching
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "multi-image-color-changer")
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def mapping_digest(mapping):
+    # Identical for any two mappings that change the same colors the same way
+    if not isinstance(mapping, ColorMapping):
+        mapping = ColorMapping(mapping)
+    mapping = mapping.changes()
+    keys, values, table = mapping.lookup()
+    tolerances = sorted(mapping.tolerances.items())
+    return hashlib.sha256(keys.tobytes() + values.tobytes() + json.dumps(tolerances).encode()).hexdigest()
+
+
+class ResultCache:
+    # On-disk cache of remap outputs keyed by (input content, mapping, output settings). Entries are
+    # files whose mtime doubles as the LRU clock; evict() trims the cache back under max_bytes.
+    # A ".clean" marker records inputs the mapping leaves untouched, so they are not even decoded.
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_BYTES, link=False):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.link = link  # Hard-link hits into place instead of copying them
+
+    def key(self, input_digest, mapping, output_path, tiled=False):
+        # mapping must be limited to the colors of the input, as ColorMapping.restricted() does, so the
+        # app and the headless remap agree on keys; tiled is whether the strip encoder writes the output
+        settings = f"{CACHE_VERSION}:{os.path.splitext(output_path)[1].lower()}:{int(tiled)}"
+        return hashlib.sha256(f"{input_digest}:{mapping_digest(mapping)}:{settings}".encode()).hexdigest()
+
+    def entry_path(self, key, suffix=".out"):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def fetch(self, key, output_path):
+        # Returns "cached" after placing the stored output at output_path, "clean" if the input
+        # is known to be unchanged by the mapping, or None on a miss
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            temporary_path = output_path + ".tmp"
+            if self.link:
+                try:
+                    os.link(entry, temporary_path)
+                except OSError:
+                    shutil.copyfile(entry, temporary_path)
+            else:
+                shutil.copyfile(entry, temporary_path)
+            os.replace(temporary_path, output_path)
+            os.utime(entry)
+            profiler.hit("result_cache", True)
+            return "cached"
+        if os.path.exists(self.entry_path(key, ".clean")):
+            os.utime(self.entry_path(key, ".clean"))
+            profiler.hit("result_cache", True)
+            return "clean"
+        profiler.hit("result_cache", False)
+        return None
+
+    def write_entry(self, entry, write):
+        # Threads of one process may write the same entry at once, so every call gets its own temporary file
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(entry))
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                write(f)
+            os.replace(temporary_path, entry)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def store(self, key, output_path):
+        def write(f):
+            with open(output_path, "rb") as output:
+                shutil.copyfileobj(output, f)
+
+        self.write_entry(self.entry_path(key), write)
+
+    def store_clean(self, key):
+        entry = self.entry_path(key, ".clean")
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        open(entry, "w").close()
+
+    def store_status(self, key, status, output_path):
+        # Keep what remap_file_uncached() did: the written output, or a marker for an unchanged input
+        if status == "written":
+            self.store(key, output_path)
+        else:
+            self.store_clean(key)
+
+    def load_input(self, input_digest):
+        # (size, indexed, colors) stored for an input content by store_input(), or None
+        entry = self.entry_path(input_digest, ".input")
+        try:
+            with np.load(entry) as data:
+                description = tuple(int(side) for side in data["size"]), bool(data["indexed"]), data["colors"]
+        except Exception:  # Missing, or cut short by an interrupted write
+            return None
+        os.utime(entry)
+        return description
+
+    def has_input(self, input_digest):
+        return os.path.exists(self.entry_path(input_digest, ".input"))
+
+    def store_input(self, input_digest, size, indexed, colors):
+        # What keys need to know about an input, so later runs can look up its outputs without decoding
+        # it. colors is the sorted array of its packed colors, as pack_colors() returns.
+        self.write_entry(
+            self.entry_path(input_digest, ".input"),
+            lambda f: np.savez(f, size=np.array(size), indexed=np.array(indexed), colors=np.asarray(colors, dtype=PIXEL_DTYPE))
+        )
+
+    def entries(self):
+        # Entry files, leaving out temporary files that are still being written
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for folder in os.listdir(self.directory):
+            folder_path = os.path.join(self.directory, folder)
+            if os.path.isdir(folder_path):
+                for name in os.listdir(folder_path):
+                    if not name.endswith(".tmp"):
+                        entries.append(os.path.join(folder_path, name))
+        return entries
+
+    def info(self):
+        entries = self.entries()
+        return len(entries), sum(os.path.getsize(entry) for entry in entries)
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits in max_bytes. Other processes may
+        # be using the cache meanwhile, so entries that disappear along the way are skipped.
+        entries = []
+        for entry in self.entries():
+            try:
+                entries.append((os.stat(entry), entry))
+            except FileNotFoundError:
+                pass
+        entries.sort(key=lambda item: item[0].st_mtime)
+        total = sum(stat.st_size for stat, entry in entries)
+        for stat, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def load_mapping(path):
+    # Mapping files are JSON lists of [source_rgba, target_rgba] pairs, optionally followed by a
+    # match tolerance
+    with open(path) as f:
+        pairs = json.load(f)
+    mapping = ColorMapping()
+    for source, target, *tolerance in pairs:
+        if len(source) != 4 or len(target) != 4 or len(tolerance) > 1:
+            raise ValueError(f"Invalid color pair in {path}: {source} -> {target}")
+        mapping[tuple(source)] = tuple(target)
+        if tolerance:
+            mapping.set_tolerance(tuple(source), tolerance[0])
+    return mapping
+
+
+def save_mapping(mapping, path):
+    pairs = []
+    for source, target in mapping.items():
+        tolerance = mapping.tolerance(source)
+        pairs.append([list(source), list(target)] + ([tolerance] if tolerance else []))
+    with open(path, "w") as f:
+        json.dump(pairs, f)
+
+
+def uses_tiled_encoder(image_size, indexed, output_path, tiled=False):
+    # Whether an output is written by the strip encoder rather than by Pillow
+    return not indexed and (tiled or use_tiled_save(image_size, output_path))
+
+
+def describe_input(cache, source_path, digest):
+    # ((size, indexed, colors), image) of an input file, with colors packed and sorted. Descriptions are kept in the cache, so inputs
+    # seen before are not decoded again. Otherwise the file is decoded and the image is returned for
+    # reuse, except for PNGs large enough to be remapped in strips, whose colors are collected strip by strip.
+    description = cache.load_input(digest)
+    if description is not None:
+        return description, None
+    header = png_stream_header(source_path)
+    if header is not None and use_tiled_save(header[:2], source_path):
+        colors = functools.reduce(np.union1d, (np.unique(pixels) for pixels in read_png_strips(source_path)))
+        image = None
+        description = header[:2], False, colors
+    else:
+        image = open_image(source_path)
+        if is_indexed(image):
+            colors = pack_colors(color for count, color in image_histogram(image))
+        else:
+            colors = np.unique(pack_pixels(image))
+        description = image.size, is_indexed(image), colors
+    cache.store_input(digest, *description)
+    return description, image
+
+
+def remap_file(source_path, output_path, mapping, tiled=False, cache=None, digest=None):
+    # Headless equivalent of Edit All Colors followed by Save for a single file, with results
+    # shared through the cache when one is given
+    if cache is None:
+        return remap_file_uncached(source_path, output_path, mapping, tiled)
+
+    # Like the app, key by the entries that hit the colors of the file and by the encoder used
+    digest = digest or file_digest(source_path)
+    (size, indexed, colors), image = describe_input(cache, source_path, digest)
+    mapping = mapping.restricted(colors)
+    key = cache.key(digest, mapping, output_path, uses_tiled_encoder(size, indexed, output_path, tiled))
+    status = cache.fetch(key, output_path)
+    if status == "clean":
+        return copy_unchanged(source_path, output_path)
+    if status is not None:
+        return status
+
+    status = remap_file_uncached(source_path, output_path, mapping, tiled, image)
+    cache.store_status(key, status, output_path)
+    return status
+
+
+def remap_files_batched(items, mapping, cache=None):
+    # remap_file() for many small (source, output, digest) items, with the pixels of every RGBA
+    # file that needs remapping looked up in one remap_batch() call. Returns a status, or the
+    # exception raised, for each item.
+    mapping = mapping.changes()
+    results = [None] * len(items)
+    batch = []
+    for position, (source_path, output_path, digest) in enumerate(items):
+        try:
+            key = status = image = None
+            image_mapping = mapping
+            if cache is not None:
+                digest = digest or file_digest(source_path)
+                (size, indexed, colors), image = describe_input(cache, source_path, digest)
+                image_mapping = mapping.restricted(colors)
+                key = cache.key(digest, image_mapping, output_path, uses_tiled_encoder(size, indexed, output_path))
+                status = cache.fetch(key, output_path)
+            if status == "clean":
+                results[position] = copy_unchanged(source_path, output_path)
+            elif status is not None:
+                results[position] = status
+            else:
+                if image is None:
+                    image = open_image(source_path)
+                if is_indexed(image) or not is_batchable(image.size):
+                    results[position] = remap_file_uncached(source_path, output_path, image_mapping, image=image)
+                    if key is not None:
+                        cache.store_status(key, results[position], output_path)
+                else:
+                    batch.append((position, key, image))
+        except Exception as e:
+            results[position] = e
+
+    remapped = remap_batch([image for position, key, image in batch], mapping)
+    for (position, key, image), new_image in zip(batch, remapped):
+        source_path, output_path, digest = items[position]
+        try:
+            if new_image is image:
+                results[position] = copy_unchanged(source_path, output_path)
+                if key is not None:
+                    cache.store_clean(key)
+            else:
+                save_image_file(new_image, output_path)
+                results[position] = "written"
+                if key is not None:
+                    cache.store(key, output_path)
+        except Exception as e:
+            results[position] = e
+    return results
+
+
+def remap_file_uncached(source_path, output_path, mapping, tiled=False, image=None):
+    # Files whose pixels the mapping does not change are never re-encoded. image is the decoded file,
+    # when the caller already has it.
+    mapping = mapping.changes()
+    if is_tiled_file(source_path, output_path, tiled):
+        return remap_file_tiled(source_path, output_path, mapping)
+    if image is None:
+        image = open_image(source_path)
+
+    if is_indexed(image):
+        # Only the palette needs rewriting; the file is written back as mode P
+        colors = palette_colors(image)
+        used = [colors[index] for count, index in image.getcolors(256)]
+        if mapping.matches(used) == used:
+            return copy_unchanged(source_path, output_path)
+        save_image_file(remap_indexed(image, mapping), output_path)
+        return "written"
+
+    if tiled or use_tiled_save(image.size, output_path):
+        if not has_hits(image, mapping):
+            return copy_unchanged(source_path, output_path)
+        save_remapped_tiled(image, mapping, output_path)
+        return "written"
+
+    keys, values, table = build_lookup(resolve_tolerances(image, mapping))
+    pixels = pack_pixels(image)
+    index, hits = find_hits(pixels, keys, table)
+
+    if not hits.any():
+        return copy_unchanged(source_path, output_path)
+
+    save_image_file(image_from_pixels(apply_hits(pixels, values, index, hits), image.size), output_path)
+    return "written"
+
+
+def is_tiled_file(source_path, output_path, tiled=False):
+    # Whether a file is remapped by remap_file_tiled(), judged from its PNG header
+    header = png_stream_header(source_path)
+    return header is not None and (tiled or use_tiled_save(header[:2], output_path))
+
+
+def copy_unchanged(source_path, output_path):
+    # Clean files keep their bytes and mtime; a copy is only made when the output is missing or stale
+    if os.path.exists(output_path):
+        if os.path.samefile(source_path, output_path):
+            return "unchanged"
+        source_stat = os.stat(source_path)
+        output_stat = os.stat(output_path)
+        if source_stat.st_size == output_stat.st_size and source_stat.st_mtime == output_stat.st_mtime:
+            return "unchanged"
+    break_hard_link(output_path)
+    shutil.copy2(source_path, output_path)
+    return "copied"
+
+
+_worker_mapping = None
+_worker_tiled = False
+_worker_cache = None
+
+
+def _init_worker(mapping, tiled, cache):
+    # Each worker process receives the mapping once instead of once per file. Its changes() and their
+    # lookup arrays are then built once per worker as well.
+    global _worker_mapping, _worker_tiled, _worker_cache
+    _worker_mapping = mapping
+    _worker_tiled = tiled
+    _worker_cache = cache
+
+
+def _remap_files_in_worker(items, batched):
+    # A status or exception for each (source, output, digest) item
+    if batched:
+        return remap_files_batched(items, _worker_mapping, _worker_cache)
+    results = []
+    for source_path, output_path, digest in items:
+        try:
+            results.append(remap_file(source_path, output_path, _worker_mapping, _worker_tiled, _worker_cache, digest))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def list_images(directory):
+    return sorted(name for name in os.listdir(directory) if name.lower().endswith(".png"))
+
+
+def group_duplicates(directory, names, jobs=None):
+    # {digest: names} of the files in directory, in name order, hashed on a thread pool
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        digests = executor.map(file_digest, (os.path.join(directory, name) for name in names))
+        groups = {}
+        for name, digest in zip(names, digests):
+            groups.setdefault(digest, []).append(name)
+    return groups
+
+
+def is_small_file(path):
+    # Whether a file is small enough to batch, judged from its header; unreadable files are not
+    try:
+        with Image.open(path) as image:
+            return is_batchable(image.size)
+    except Exception:
+        return False
+
+
+def copy_duplicate(status, first_output_path, source_path, output_path):
+    # Give a byte-identical input the output its first copy got, without remapping it again
+    if status in ("written", "cached"):
+        break_hard_link(output_path)
+        shutil.copyfile(first_output_path, output_path)
+        return "duplicate"
+    return copy_unchanged(source_path, output_path)
+
+
+@profiler.span("remap_directory")
+def remap_directory(mapping, input_dir, output_dir, jobs=None, report=print, tiled=False, cache=None, batch=False):
+    # Remap every PNG in input_dir into output_dir across a process pool, returning the failures.
+    # Byte-identical inputs are remapped once and the other copies reuse that output. With batch,
+    # small images are handed to workers BATCH_FILES at a time and remapped together.
+    os.makedirs(output_dir, exist_ok=True)
+    groups = list(group_duplicates(input_dir, list_images(input_dir), jobs).items())
+    chunks = [([names], False) for digest, names in groups]
+    if batch and not tiled:
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            small = list(executor.map(is_small_file, (os.path.join(input_dir, names[0]) for digest, names in groups)))
+        chunks = [([names], False) for (digest, names), is_small in zip(groups, small) if not is_small]
+        small_groups = [names for (digest, names), is_small in zip(groups, small) if is_small]
+        chunks += [(small_groups[start:start + BATCH_FILES], True) for start in range(0, len(small_groups), BATCH_FILES)]
+    digests = {names[0]: digest for digest, names in groups}
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=_init_worker, initargs=(mapping, tiled, cache)) as executor:
+        futures = {}
+        for chunk, batched in chunks:
+            items = [(os.path.join(input_dir, names[0]), os.path.join(output_dir, names[0]), digests[names[0]]) for names in chunk]
+            futures[executor.submit(_remap_files_in_worker, items, batched)] = chunk
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                outcomes = future.result()
+            except Exception as e:
+                outcomes = [e] * len(chunk)
+            for names, outcome in zip(chunk, outcomes):
+                for name in names:
+                    profiler.add(images=1)
+                    try:
+                        if isinstance(outcome, Exception):
+                            raise outcome
+                        status = outcome
+                        if name != names[0]:
+                            status = copy_duplicate(
+                                status, os.path.join(output_dir, names[0]), os.path.join(input_dir, name), os.path.join(output_dir, name)
+                            )
+                        report(f"{name}: {status}")
+                    except Exception as e:
+                        failures.append((name, e))
+                        report(f"{name}: failed ({e})")
+    if cache is not None:
+        cache.evict()
+    return failures
+
+
+WATCH_INTERVAL = 0.25  # Seconds between scans of a watched directory
+WATCH_DEBOUNCE = 0.2  # Seconds a file must stay unchanged before it is remapped
+WATCH_EVICT_INTERVAL = 60  # Seconds between result cache evictions while files are being written
+
+
+def scan_images(directory):
+    # {name: (mtime_ns, size)} of the PNGs in directory, from a single directory listing
+    images = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".png") and entry.is_file():
+                stat = entry.stat()
+                images[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return images
+
+
+def is_stale(source_path, output_path, mapping_path):
+    # Outputs older than their source or the mapping they were made with need remapping
+    try:
+        source_mtime = max(os.stat(source_path).st_mtime_ns, os.stat(mapping_path).st_mtime_ns)
+    except FileNotFoundError:
+        return False  # Deleted since the scan
+    try:
+        return os.stat(output_path).st_mtime_ns < source_mtime
+    except FileNotFoundError:
+        return True
+
+
+def watch_directory(
+    mapping_path, input_dir, output_dir, jobs=None, report=print, tiled=False, cache=None,
+    interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE, stop=None
+):
+    # Keep output_dir in step with input_dir until stop() returns true: PNGs are remapped once their
+    # size and mtime have been stable for debounce seconds, and only if their output is stale. The
+    # mapping file is watched too; when it changes every image is checked against it again.
+    os.makedirs(output_dir, exist_ok=True)
+    mapping_signature = ()  # Matches no stat result, so the first pass loads the mapping
+    executor = None
+    seen = {}  # Name -> (mtime_ns, size) of the version last handled
+    changing = {}  # Name -> ((mtime_ns, size), monotonic time it was first seen)
+    running = {}  # Future -> name
+    evicted = time.monotonic()
+    done_since_eviction = False
+    try:
+        while stop is None or not stop():
+            try:
+                stat = os.stat(mapping_path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                signature = None  # Missing for a moment while an editor replaces it
+            if signature != mapping_signature:
+                mapping_signature = signature
+                try:
+                    mapping = load_mapping(mapping_path)
+                except (OSError, TypeError, ValueError) as e:
+                    # Missing, caught halfway through being written, or not a list of color pairs;
+                    # the previous mapping stays in use
+                    report(f"{mapping_path}: not reloaded ({e})")
+                else:
+                    if executor is not None:
+                        executor.shutdown()
+                    executor = ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=_init_worker, initargs=(mapping, tiled, cache))
+                    seen.clear()
+                    report(f"{mapping_path}: loaded {len(mapping)} colors")
+
+            now = time.monotonic()
+            current = scan_images(input_dir)
+            busy = set(running.values())
+            for name, signature in current.items():
+                if seen.get(name) == signature or name in busy or executor is None:
+                    continue
+                first_seen = changing.get(name)
+                if first_seen is None or first_seen[0] != signature:
+                    changing[name] = (signature, now)
+                    continue
+                if now - first_seen[1] < debounce:
+                    continue
+                del changing[name]
+                seen[name] = signature
+                source_path = os.path.join(input_dir, name)
+                output_path = os.path.join(output_dir, name)
+                if is_stale(source_path, output_path, mapping_path):
+                    running[executor.submit(_remap_files_in_worker, [(source_path, output_path, None)], False)] = name
+            for name in [name for name in seen if name not in current]:
+                del seen[name]
+
+            # Sleep until the next scan, but report finished files as soon as they are done
+            if running:
+                wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(interval)
+            for future in [future for future in running if future.done()]:
+                name = running.pop(future)
+                done_since_eviction = True
+                profiler.add(images=1)
+                try:
+                    outcome = future.result()[0]
+                    if isinstance(outcome, Exception):
+                        raise outcome
+                    report(f"{name}: {outcome}")
+                except Exception as e:
+                    report(f"{name}: failed ({e})")
+
+            # Keep the cache under its size cap during long sessions, not just when they end
+            if cache is not None and done_since_eviction and time.monotonic() - evicted >= WATCH_EVICT_INTERVAL:
+                cache.evict()
+                evicted = time.monotonic()
+                done_since_eviction = False
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            cache.evict()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="color_engine", description="Headless color remapping for PNG files.")
+    parser.add_argument("--trace", help=f"Write a Chrome trace of the run to this file (or set {TRACE_ENV})")
+    parser.add_argument("--cprofile", help=f"Write a cProfile capture of the run to this file (or set {CPROFILE_ENV})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    remap_parser = subparsers.add_parser("remap", help="Apply a color mapping to every PNG in a directory.")
+    remap_parser.add_argument("--map", required=True, dest="mapping", help="JSON file of [source_rgba, target_rgba] pairs")
+    remap_parser.add_argument("--in", required=True, dest="input_dir", help="Directory of source PNGs")
+    remap_parser.add_argument("--out", required=True, dest="output_dir", help="Directory to write remapped PNGs to")
+    remap_parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    remap_parser.add_argument("--tiled", action="store_true", help="Remap and encode every RGBA image in strips (default: only very large ones)")
+    remap_parser.add_argument("--batch", action="store_true", help=f"Remap images of up to {BATCH_MAX_PIXELS} pixels together, {BATCH_FILES} files per worker task")
+    remap_parser.add_argument("--no-cache", action="store_true", help="Do not read or write the result cache")
+    remap_parser.add_argument("--link", action="store_true", help="Hard-link cached results into place instead of copying them")
+    remap_parser.add_argument("--cache-dir", help=f"Result cache directory (or set {CACHE_DIR_ENV})")
+    remap_parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024), help="Result cache size cap in MiB")
+
+    watch_parser = subparsers.add_parser("watch", help="Keep a directory of remapped PNGs up to date as the sources change.")
+    watch_parser.add_argument("--map", required=True, dest="mapping", help="JSON file of [source_rgba, target_rgba] pairs; reloaded when it changes")
+    watch_parser.add_argument("--in", required=True, dest="input_dir", help="Directory of source PNGs to watch")
+    watch_parser.add_argument("--out", required=True, dest="output_dir", help="Directory to write remapped PNGs to")
+    watch_parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    watch_parser.add_argument("--tiled", action="store_true", help="Remap and encode every RGBA image in strips (default: only very large ones)")
+    watch_parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="Seconds between directory scans")
+    watch_parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, help="Seconds a file must stay unchanged before it is remapped")
+    watch_parser.add_argument("--no-cache", action="store_true", help="Do not read or write the result cache")
+    watch_parser.add_argument("--cache-dir", help=f"Result cache directory (or set {CACHE_DIR_ENV})")
+    watch_parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024), help="Result cache size cap in MiB")
+
+    cache_parser = subparsers.add_parser("cache", help="Inspect or invalidate the result cache.")
+    cache_parser.add_argument("action", choices=("info", "clear"))
+    cache_parser.add_argument("--cache-dir", help=f"Result cache directory (or set {CACHE_DIR_ENV})")
+
+    args = parser.parse_args(argv)
+
+    if args.trace or args.cprofile:
+        profiler.enable(args.trace, args.cprofile)
+    else:
+        profiler.enable_from_env()
+
+    if args.command == "remap":
+        cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_size * 1024 * 1024, args.link)
+        failures = remap_directory(
+            load_mapping(args.mapping), args.input_dir, args.output_dir, args.jobs, tiled=args.tiled, cache=cache, batch=args.batch
+        )
+        if failures:
+            print(f"{len(failures)} file(s) failed.", file=sys.stderr)
+            return 1
+    elif args.command == "watch":
+        cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        try:
+            watch_directory(
+                args.mapping, args.input_dir, args.output_dir, args.jobs, tiled=args.tiled, cache=cache,
+                interval=args.interval, debounce=args.debounce
+            )
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "cache":
+        cache = ResultCache(args.cache_dir)
+        if args.action == "clear":
+            cache.clear()
+            print(f"Cleared {cache.directory}")
+        else:
+            count, size = cache.info()
+            print(f"{cache.directory}: {count} entries, {size / (1024 * 1024):.1f} MiB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
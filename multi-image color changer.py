@@ -1,18 +1,344 @@
+import argparse
+import math
+import os
 import tkinter as tk
-from tkinter import filedialog, messagebox, Toplevel
+import tkinter.font as tkfont
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import filedialog, messagebox, ttk, Toplevel
+import numpy as np
 from PIL import Image, ImageTk
 from os.path import basename as filename
+from color_engine import (
+    CPROFILE_ENV, DEFAULT_MEMORY_BUDGET, PIXEL_DTYPE, TRACE_ENV, ColorMapping, ImageStore, ResultCache, file_digest,
+    image_histogram, is_batchable, is_lossless_path, open_image, pack_color, pack_colors, profiler, remap_histogram,
+    save_image_file, save_remapped_tiled, unpack_color, uses_tiled_encoder
+)
+
+PREVIEW_SIZE = (480, 320)  # Largest viewport of each preview canvas, in screen pixels
+
+
+class PreviewCache:
+    # LRU of scaled preview PhotoImages keyed by (image key, kind, version, resize factor, visible box)
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key, render):
+        preview = self.entries.get(key)
+        profiler.hit("preview_cache", preview is not None)
+        if preview is None:
+            preview = render()
+            self.put(key, preview)
+        else:
+            self.entries.move_to_end(key)
+        return preview
+
+    def put(self, key, preview):
+        self.entries[key] = preview
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class ColorList(tk.Frame):
+    # Scrollable list of "original - edited" color rows backed by packed color arrays.
+    # Only the rows that fit in the widget are ever inserted into the underlying Listbox.
+    def __init__(self, master, width=40, height=10):
+        super().__init__(master)
+        self.colors = np.zeros(0, dtype=PIXEL_DTYPE)  # Original color of each row
+        self.edited_colors = np.zeros(0, dtype=PIXEL_DTYPE)  # Edited color of each row
+        self.top = 0  # Model index of the first visible row
+        self.visible_rows = height
+        self.selected = None  # Model index of the selected row
+
+        self.listbox = tk.Listbox(self, selectmode=tk.SINGLE, width=width, height=height, exportselection=False)
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.row_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<Configure>", self.on_configure)
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll_by(-1 if event.delta > 0 else 1) or "break")
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_by(-1) or "break")
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_by(1) or "break")
+
+    def set_colors(self, colors, edited_colors):
+        self.colors = np.fromiter((pack_color(color) for color in colors), dtype=PIXEL_DTYPE, count=len(colors))
+        self.edited_colors = np.fromiter((pack_color(color) for color in edited_colors), dtype=PIXEL_DTYPE, count=len(edited_colors))
+        self.selected = None
+        self.top = min(self.top, max(len(self.colors) - self.visible_rows, 0))
+        self.render()
+
+    def clear(self):
+        self.set_colors([], [])
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def color(self, index):
+        return unpack_color(self.colors[index])
+
+    def edited_color(self, index):
+        return unpack_color(self.edited_colors[index])
+
+    def bind_rows(self, sequence, func):
+        self.listbox.bind(sequence, func)
+
+    def render(self):
+        self.listbox.delete(0, tk.END)
+        end = min(self.top + self.visible_rows, len(self.colors))
+        for index in range(self.top, end):
+            self.listbox.insert(tk.END, f"{self.color(index)} - {self.edited_color(index)}")
+        if self.selected is not None and self.top <= self.selected < end:
+            self.listbox.selection_set(self.selected - self.top)
+
+        if len(self.colors) == 0:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.top / len(self.colors), end / len(self.colors))
+
+    def scroll_to(self, top):
+        top = max(0, min(top, len(self.colors) - self.visible_rows))
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def scroll_by(self, rows):
+        self.scroll_to(self.top + rows)
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * len(self.colors)))
+        elif unit == "pages":
+            self.scroll_by(int(amount) * self.visible_rows)
+        else:
+            self.scroll_by(int(amount))
+
+    def on_configure(self, event):
+        visible_rows = max(1, event.height // self.row_height)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.top = max(0, min(self.top, len(self.colors) - visible_rows))
+            self.render()
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+
+class PreviewCanvas(tk.Frame):
+    # Scrollable, zoomed view of an image. Only the image pixels inside the viewport are scaled,
+    # so memory and latency depend on the viewport size rather than on image size times zoom.
+    def __init__(self, master, width=PREVIEW_SIZE[0], height=PREVIEW_SIZE[1]):
+        super().__init__(master)
+        self.max_width = width
+        self.max_height = height
+        self.image_size = None
+        self.zoom = 1
+        self.render_box = None  # Called with an (left, top, right, bottom) image box, returns a PhotoImage
+        self.box = None  # Image box currently shown
+        self.photo = None
+        self.linked = []  # Views that scroll together with this one
+
+        self.canvas = tk.Canvas(self, width=width, height=height, highlightthickness=0)
+        self.x_scrollbar = tk.Scrollbar(self, orient=tk.HORIZONTAL, command=self.on_xview)
+        self.y_scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_yview)
+        self.canvas.config(xscrollcommand=self.x_scrollbar.set, yscrollcommand=self.y_scrollbar.set)
+        self.canvas.grid(row=0, column=0)
+        self.y_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.x_scrollbar.grid(row=1, column=0, sticky="ew")
+        self.item = self.canvas.create_image(0, 0, anchor=tk.NW)
+
+        self.canvas.bind("<Configure>", lambda event: self.render())
+        self.canvas.bind("<MouseWheel>", lambda event: self.on_yview("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.canvas.bind("<Shift-MouseWheel>", lambda event: self.on_xview("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.canvas.bind("<Button-4>", lambda event: self.on_yview("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda event: self.on_yview("scroll", 1, "units"))
+
+    def show(self, image_size, zoom, render_box):
+        # Display an image of image_size at zoom; the scroll position is kept when possible
+        resized = (image_size, zoom) != (self.image_size, self.zoom)
+        self.image_size = image_size
+        self.zoom = zoom
+        self.render_box = render_box
+        self.box = None
+        if resized:
+            width, height = image_size[0] * zoom, image_size[1] * zoom
+            self.canvas.config(
+                width=min(width, self.max_width), height=min(height, self.max_height), scrollregion=(0, 0, width, height),
+                xscrollincrement=zoom, yscrollincrement=zoom
+            )
+        self.render()
+
+    def clear(self):
+        self.image_size = None
+        self.render_box = None
+        self.box = None
+        self.photo = None
+        self.canvas.itemconfig(self.item, image="")
+
+    def visible_box(self):
+        # Image pixels covered by the viewport, including partially visible ones
+        left = self.canvas.canvasx(0)
+        top = self.canvas.canvasy(0)
+        width = int(self.canvas.cget("width"))
+        height = int(self.canvas.cget("height"))
+        if self.canvas.winfo_ismapped():
+            width = min(width, self.canvas.winfo_width())
+            height = min(height, self.canvas.winfo_height())
+        return (
+            max(0, int(left // self.zoom)),
+            max(0, int(top // self.zoom)),
+            min(self.image_size[0], math.ceil((left + width) / self.zoom)),
+            min(self.image_size[1], math.ceil((top + height) / self.zoom)),
+        )
+
+    def render(self):
+        if self.render_box is None:
+            return
+        box = self.visible_box()
+        if box == self.box or box[0] >= box[2] or box[1] >= box[3]:
+            return
+        self.box = box
+        self.photo = self.render_box(box)
+        self.canvas.coords(self.item, box[0] * self.zoom, box[1] * self.zoom)
+        self.canvas.itemconfig(self.item, image=self.photo)
+
+    def image_point(self, event):
+        # Image pixel under a mouse event, or None outside the image
+        if self.image_size is None:
+            return None
+        x = int(self.canvas.canvasx(event.x) // self.zoom)
+        y = int(self.canvas.canvasy(event.y) // self.zoom)
+        if 0 <= x < self.image_size[0] and 0 <= y < self.image_size[1]:
+            return x, y
+        return None
+
+    def bind_image(self, sequence, func):
+        self.canvas.bind(sequence, func)
+
+    def on_xview(self, *args):
+        self.canvas.xview(*args)
+        self.render()
+        for view in self.linked:
+            view.canvas.xview_moveto(self.canvas.xview()[0])
+            view.render()
+
+    def on_yview(self, *args):
+        self.canvas.yview(*args)
+        self.render()
+        for view in self.linked:
+            view.canvas.yview_moveto(self.canvas.yview()[0])
+            view.render()
+
+class JobRunner:
+    # Runs heavy work on background threads and hands results back to the Tk thread with root.after.
+    # Submitting a job under a key that is still in flight supersedes the older job, whose result is dropped.
+    def __init__(self, root, poll_interval=30):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self.jobs = {}  # Job key -> (future, on_done, on_error)
+        self.polling = False
+
+    def submit(self, key, work, on_done, on_error=None):
+        previous = self.jobs.pop(key, None)
+        if previous is not None:
+            previous[0].cancel()
+        self.jobs[key] = (self.executor.submit(work), on_done, on_error)
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.poll_interval, self.poll)
+
+    def pending(self, key):
+        return key in self.jobs
+
+    def cancel_all(self):
+        for future, on_done, on_error in self.jobs.values():
+            future.cancel()
+        self.jobs.clear()
+
+    def poll(self):
+        for key, job in list(self.jobs.items()):
+            future, on_done, on_error = job
+            # Skip jobs that finished but were superseded by a callback earlier in this pass
+            if not future.done() or self.jobs.get(key) is not job:
+                continue
+            del self.jobs[key]
+            try:
+                result = future.result()
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                else:
+                    messagebox.showerror("Error", str(e))
+            else:
+                on_done(result)
+
+        if self.jobs:
+            self.root.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False
+
+
+class EditHistory:
+    # Undo and redo stacks of edits. An edit only holds the mapping entries it changed and the
+    # mappings its images had before and after, so memory does not grow with image size.
+    def __init__(self, max_entries=200):
+        self.max_entries = max_entries
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def new_edit(self):
+        return {"entries": [], "images": []}
+
+    def push(self, edit):
+        if not edit["entries"] and not edit["images"]:
+            return
+        self.undo_stack.append(edit)
+        del self.undo_stack[:-self.max_entries]
+        self.redo_stack.clear()
+
+    def undo(self):
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        self.redo_stack.append(edit)
+        return edit
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        self.undo_stack.append(edit)
+        return edit
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
 
 class ImageEditorApp:
-    def __init__(self, root):
+    def __init__(self, root, memory_budget=DEFAULT_MEMORY_BUDGET):
         self.root = root
         self.root.title("Image Editor")
         self.root.resizable(False, False)
 
-        self.images = []  # Stores dictionaries with image data
+        self.images = []  # Stores dictionaries with image metadata
+        self.store = ImageStore(memory_budget)  # Decoded pixel data for the images, loaded on demand
         self.open_toplevels = {}  # Track open Toplevels by a unique key
-        self.custom_colors = {}  # Track changed colors of images
+        self.custom_colors = ColorMapping()  # Track changed colors of images
+        self.color_refcounts = Counter()  # Number of loaded images containing each color
+        self.sorted_colors = None  # Cached sorted union of visible colors across all images
         self.selected_image_index = None
+        self.preview_cache = PreviewCache()
+        self.jobs = JobRunner(self.root)  # Background remaps and image loads
+        self.result_cache = ResultCache()  # Saved outputs shared with the headless remap command
+        self.history = EditHistory()  # Undo/redo of color edits and resets
+        self.batched_images = {}  # Image key -> key of the batch job still rendering that image
 
         # Frames for layout
         self.left_frame = tk.Frame(self.root)
@@ -41,34 +367,45 @@ class ImageEditorApp:
         self.reset_all_changes_button = tk.Button(self.left_frame, text="Reset All Changes", command=self.reset_all_changes, state=tk.DISABLED)
         self.reset_all_changes_button.pack(pady=5)
 
+        self.undo_button = tk.Button(self.left_frame, text="Undo", command=self.undo, state=tk.DISABLED)
+        self.undo_button.pack(pady=5)
+
+        self.redo_button = tk.Button(self.left_frame, text="Redo", command=self.redo, state=tk.DISABLED)
+        self.redo_button.pack(pady=5)
+
         self.resize_label = tk.Label(self.left_frame, text="Resize Factor:")
         self.resize_label.pack(pady=5)
         
         self.resize_factor = tk.IntVar(value=1)
-        self.resize_spinbox = tk.Spinbox(self.left_frame, values=(1, 2, 4, 8), width=5, textvariable=self.resize_factor, state="readonly")
+        self.resize_spinbox = tk.Spinbox(self.left_frame, values=(1, 2, 4, 8), width=5, textvariable=self.resize_factor, state="readonly", command=self.update_previews)
         self.resize_spinbox.pack(pady=5)
 
-        self.resize_note = tk.Label(self.left_frame, text="To apply resize factor,\nreclick the image you\nwere just editing.")
-        self.resize_note.pack(pady=5)
+        # Remap small images together in one pass when a color is changed for all images
+        self.batch_small_images = tk.BooleanVar(value=False)
+        self.batch_checkbutton = tk.Checkbutton(self.left_frame, text="Batch small images", variable=self.batch_small_images)
+        self.batch_checkbutton.pack(pady=5)
 
-        # Image Preview Panels
+        # Image Preview Panels, which scroll together
         self.original_preview_label = tk.Label(self.right_frame, text="Original Image")
         self.original_preview_label.pack()
-        self.original_preview = tk.Label(self.right_frame)
+        self.original_preview = PreviewCanvas(self.right_frame)
         self.original_preview.pack(pady=5)
-        self.original_preview.bind("<Button-1>", self.on_original_preview_click)
+        self.original_preview.bind_image("<Button-1>", self.on_original_preview_click)
 
         self.edited_preview_label = tk.Label(self.right_frame, text="Edited Image")
         self.edited_preview_label.pack()
-        self.edited_preview = tk.Label(self.right_frame)
+        self.edited_preview = PreviewCanvas(self.right_frame)
         self.edited_preview.pack(pady=5)
-        self.edited_preview.bind("<Button-1>", self.on_edited_preview_click)
+        self.edited_preview.bind_image("<Button-1>", self.on_edited_preview_click)
+
+        self.original_preview.linked.append(self.edited_preview)
+        self.edited_preview.linked.append(self.original_preview)
 
         # Colors Listbox
         self.colors_label = tk.Label(self.right_frame, text="Colors")
         self.colors_label.pack(pady=5)
 
-        self.colors_listbox = tk.Listbox(self.right_frame, selectmode=tk.SINGLE, width=40)
+        self.colors_listbox = ColorList(self.right_frame, width=40)
         self.colors_listbox.pack(pady=5)
 
         self.edit_color_button = tk.Button(self.right_frame, text="Edit Color", command=self.edit_color, state=tk.DISABLED)
@@ -88,8 +425,11 @@ class ImageEditorApp:
         self.save_all_button = tk.Button(self.right_frame, text="Save All Images", command=self.save_all_images, state=tk.DISABLED)
         self.save_all_button.pack(pady=5, fill=tk.X)
 
-        self.colors_listbox.bind("<Double-1>", self.edit_color)
+        self.colors_listbox.bind_rows("<Double-1>", self.edit_color)
         self.image_listbox.bind("<Double-1>", self.edit_all_colors)
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        self.root.bind("<Control-Z>", lambda event: self.redo())
 
     def change_states(self, state):
         self.delete_button.config(state=state)
@@ -142,19 +482,257 @@ class ImageEditorApp:
     def add_image(self):
         file_paths = filedialog.askopenfilenames(filetypes=[("PNG Files", "*.png")])
         if file_paths:
-            try:
-                for file_path in file_paths:
-                    image = Image.open(file_path).convert("RGBA")
-                    self.images.append({
-                        "path": file_path,
-                        "image": image,
-                        "edited_image": image.copy(),
-                        "colors": {},
-                    })
-                self.update_image_listbox()
-                self.change_states(tk.NORMAL)
-            except Exception as e:
+            # Images are decoded in the background and added in the order they were selected
+            pending = []
+            loaded = {}  # Image key -> (image, histogram), or None if loading failed
+
+            @profiler.span("add_image")
+            def on_loaded(img_data, result):
+                loaded[img_data["key"]] = result
+                added = False
+                while pending and pending[0]["key"] in loaded:
+                    ready = pending.pop(0)
+                    result = loaded.pop(ready["key"])
+                    if result is not None:
+                        image, histogram, digest = result
+                        ready["digest"] = digest  # Content hash of the file, used by the result cache
+                        self.set_original_image(ready, image, histogram)
+                        self.images.append(ready)
+                        profiler.add(images=1)
+                        added = True
+
+                if added:
+                    self.update_image_listbox()
+                    self.change_states(tk.NORMAL)
+                    if "edit_all_colors" in self.open_toplevels:
+                        self.open_toplevels["edit_all_colors_update"]()
+
+            def on_failed(img_data, e):
                 messagebox.showerror("Error", f"Failed to load image: {e}")
+                on_loaded(img_data, None)
+
+            for file_path in file_paths:
+                img_data = {
+                    "key": self.store.new_key(),
+                    "path": file_path,
+                    "colors": ColorMapping(),
+                }
+                pending.append(img_data)
+                self.jobs.submit(
+                    ("load", img_data["key"]),
+                    lambda file_path=file_path: self.load_file(file_path),
+                    lambda result, img_data=img_data: on_loaded(img_data, result),
+                    lambda e, img_data=img_data: on_failed(img_data, e)
+                )
+
+    def load_file(self, path):
+        # Files are identified by content, so byte-identical files are decoded only once and share
+        # their pixels, histogram and renders; safe to run on a background thread
+        digest = file_digest(path)
+        image, histogram = self.store.load(path, digest)
+        return image, histogram, digest
+
+    def selected_image(self):
+        if self.selected_image_index is not None and self.selected_image_index < len(self.images):
+            return self.images[self.selected_image_index]
+        return None
+
+    def apply_mapping(self, img_data, mapping):
+        # The mapping is recorded right away; the edited pixels are rendered in the background
+        if not self.store.set_mapping(img_data, mapping) or not img_data["mapping"]:
+            return
+
+        profiler.add(images=1)
+        version = img_data["version"]
+        mapping = img_data["mapping"]
+
+        def on_done(edited_image):
+            # The render is kept by the store, shared with every image of the same content and mapping
+            if img_data["version"] == version and self.selected_image() is img_data:
+                self.update_previews()
+
+        self.jobs.submit(("remap", img_data["key"]), lambda: self.store.render(img_data, mapping), on_done)
+
+    def apply_mapping_all(self, images, mapping):
+        # Like apply_mapping for every image, except that in batching mode small RGBA images are
+        # remapped together by a single background job
+        if not self.batch_small_images.get():
+            for img_data in images:
+                self.apply_mapping(img_data, mapping)
+            return
+
+        batch = []
+        for img_data in images:
+            if img_data.get("indexed") or not is_batchable(img_data["size"]):
+                self.apply_mapping(img_data, mapping)
+            elif self.store.set_mapping(img_data, mapping) and img_data["mapping"]:
+                batch.append((img_data, img_data["version"], img_data["mapping"]))
+        if not batch:
+            return
+
+        profiler.add(images=len(batch))
+        snapshot = mapping.copy()  # The job must not see later edits of the live mapping
+        job_key = ("remap_batch", self.store.new_key())
+        for img_data, version, record_mapping in batch:
+            self.batched_images[img_data["key"]] = job_key
+
+        def finish():
+            for img_data, version, record_mapping in batch:
+                if self.batched_images.get(img_data["key"]) == job_key:
+                    del self.batched_images[img_data["key"]]
+
+        def on_done(result):
+            finish()
+            selected = self.selected_image()
+            if any(img_data is selected and img_data["version"] == version for img_data, version, record_mapping in batch):
+                self.update_previews()
+
+        def on_error(e):
+            finish()
+            messagebox.showerror("Error", str(e))
+
+        self.jobs.submit(job_key, lambda: self.store.render_batch(batch, snapshot), on_done, on_error)
+
+    def is_rendering(self, img_data):
+        # Whether a background job is still rendering the edited image
+        return self.jobs.pending(("remap", img_data["key"])) or img_data["key"] in self.batched_images
+
+    def set_color_entry(self, edit, mapping, color, new_color, tolerance=0):
+        # Change one mapping entry, recording it in edit so it can be undone
+        before = mapping.entry(color)
+        mapping[color] = new_color
+        mapping.set_tolerance(color, tolerance)
+        edit["entries"].append((mapping, color, before, mapping.entry(color)))
+
+    def clear_color_entries(self, edit, mapping):
+        for color in list(mapping):
+            edit["entries"].append((mapping, color, mapping.entry(color), None))
+        mapping.clear()
+
+    def record_mapping(self, edit, images, change):
+        # Run change(), which may replace the mappings of images, and record the mappings they had before
+        before = [img_data["mapping"] for img_data in images]
+        change()
+        for img_data, mapping in zip(images, before):
+            if img_data["mapping"] is not mapping:
+                edit["images"].append((img_data, mapping, img_data["mapping"]))
+
+    def commit_edit(self, edit):
+        self.history.push(edit)
+        self.update_history_buttons()
+
+    def replay_edit(self, edit, undo):
+        # Put the changed entries and image mappings back to their state before (undo) or after the edit.
+        # Only the affected images are re-rendered; images deleted since the edit are skipped.
+        entries = reversed(edit["entries"]) if undo else edit["entries"]
+        for mapping, color, before, after in entries:
+            mapping.set_entry(color, before if undo else after)
+
+        live = {img_data["key"] for img_data in self.images}
+        for img_data, before, after in edit["images"]:
+            if img_data["key"] in live:
+                self.apply_mapping(img_data, before if undo else after)
+
+        self.update_history_buttons()
+        self.update_previews()
+        self.update_colors_listbox()
+
+    def undo(self):
+        edit = self.history.undo()
+        if edit is not None:
+            self.replay_edit(edit, undo=True)
+
+    def redo(self):
+        edit = self.history.redo()
+        if edit is not None:
+            self.replay_edit(edit, undo=False)
+
+    def clear_history(self):
+        self.history.clear()
+        self.update_history_buttons()
+
+    def update_history_buttons(self):
+        self.undo_button.config(state=tk.NORMAL if self.history.undo_stack else tk.DISABLED)
+        self.redo_button.config(state=tk.NORMAL if self.history.redo_stack else tk.DISABLED)
+
+    def set_original_image(self, img_data, image, histogram=None):
+        # Replace the original image of a record and rebuild everything derived from it
+        if "color_index" in img_data:
+            self.untrack_colors(img_data)
+        if histogram is None:
+            histogram = image_histogram(image)  # Only recomputed when the image is replaced
+        self.store.set_original(img_data, image, histogram, img_data.get("digest"))
+        img_data["histogram"] = histogram
+        img_data["color_index"] = frozenset(color for count, color in img_data["histogram"])
+        self.track_colors(img_data)
+
+    def save_edited_image(self, img_data, path):
+        # Write the edited image and make it the new original of the record
+        digest, output_image = self.prepare_save(img_data, path)()
+        self.promote_saved_image(img_data, path, output_image, digest)
+
+    def prepare_save(self, img_data, path):
+        # Returns the work that writes the file. The work may run on a worker thread: it decodes and
+        # renders the image as needed, and returns the content hash of the written file and the image
+        # it wrote. Very large RGBA images are streamed in strips, in which case no image is returned.
+        tiled = self.store.is_dirty(img_data) and uses_tiled_encoder(img_data["size"], img_data.get("indexed"), path)
+        mapping = img_data["mapping"]
+
+        # Outputs already produced from the same file content and mapping are reused from the cache,
+        # including those of the headless remap command, which keys files the same way. Clean images
+        # are only re-encoded, so there is no remapped output worth keeping for them.
+        key = None
+        if self.result_cache is not None and img_data.get("digest") and self.store.is_dirty(img_data):
+            key = self.result_cache.key(img_data["digest"], mapping, path, tiled)
+            description = (img_data["size"], bool(img_data.get("indexed")), img_data["color_index"])
+
+        def save():
+            output_image = None if tiled else self.store.output(img_data)
+            status = None if key is None else self.result_cache.fetch(key, path)
+            if status != "cached":
+                if tiled:
+                    save_remapped_tiled(self.store.original(img_data), mapping, path)
+                else:
+                    save_image_file(output_image, path)
+                if status is None and key is not None:
+                    self.result_cache.store(key, path)
+                    if not self.result_cache.has_input(img_data["digest"]):
+                        size, indexed, colors = description
+                        self.result_cache.store_input(img_data["digest"], size, indexed, pack_colors(colors))
+            return file_digest(path), output_image
+
+        return save
+
+    def promote_saved_image(self, img_data, path, output_image, digest):
+        img_data["path"] = path
+        img_data["digest"] = digest
+        self.clear_history()  # Edits made before the save no longer apply to the new original
+
+        if output_image is None:
+            # Streamed saves never held the full edited image; it is decoded from the file when next needed
+            self.set_original_image(img_data, None, remap_histogram(img_data["histogram"], img_data["mapping"]))
+        elif is_lossless_path(path):
+            # The file holds exactly the edited pixels, so promote the buffer instead of decoding it again
+            self.set_original_image(img_data, output_image, remap_histogram(img_data["histogram"], img_data["mapping"]))
+        else:
+            self.set_original_image(img_data, open_image(path))
+
+    def track_colors(self, img_data):
+        self.color_refcounts.update(img_data["color_index"])
+        self.sorted_colors = None
+
+    def untrack_colors(self, img_data):
+        self.color_refcounts.subtract(img_data["color_index"])
+        for color in img_data["color_index"]:
+            if self.color_refcounts[color] <= 0:
+                del self.color_refcounts[color]
+        self.sorted_colors = None
+
+    def get_all_unique_colors(self):
+        # Union of all image colors, kept up to date as images are added, replaced and deleted
+        if self.sorted_colors is None:
+            self.sorted_colors = sorted(color for color in self.color_refcounts if color[3] != 0)  # Exclude fully transparent colors
+        return self.sorted_colors
 
     def delete_image(self):
         selected_indices = self.image_listbox.curselection()
@@ -162,25 +740,34 @@ class ImageEditorApp:
             return
 
         for index in reversed(selected_indices):
+            self.untrack_colors(self.images[index])
+            self.store.discard(self.images[index])
             del self.images[index]
 
         if len(self.images) == 0:
             self.change_states(tk.DISABLED)
-            self.original_preview.config(image="")
-            self.edited_preview.config(image="")
-            self.colors_listbox.delete(0, tk.END)
+            self.original_preview.clear()
+            self.edited_preview.clear()
+            self.colors_listbox.clear()
 
         self.update_image_listbox()
         self.update_previews()
         self.update_colors_listbox()
 
     def clear_all_images(self):
+        self.jobs.cancel_all()
+        self.batched_images.clear()
+        self.clear_history()
         self.images.clear()
+        self.store.clear()
+        self.preview_cache.clear()
+        self.color_refcounts.clear()
+        self.sorted_colors = None
 
         self.change_states(tk.DISABLED)
-        self.original_preview.config(image="")
-        self.edited_preview.config(image="")
-        self.colors_listbox.delete(0, tk.END)
+        self.original_preview.clear()
+        self.edited_preview.clear()
+        self.colors_listbox.clear()
 
         self.update_image_listbox()
         self.update_previews()
@@ -199,71 +786,73 @@ class ImageEditorApp:
             name = filename(img_data["path"])
             self.image_listbox.insert(tk.END, name)
 
+    @profiler.span("update_previews")
     def update_previews(self, event=None):
         if "edit_all_colors" in self.open_toplevels:
             self.open_toplevels["edit_all_colors_update"]()
             
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
-            
-            # If the path has changed (after save), reload the image
-            if img_data["path"] != img_data.get("previous_path"):
-                img_data["previous_path"] = img_data["path"]
-                # Reload the image based on the updated path
-                updated_image = Image.open(img_data["path"]).convert("RGBA")
-                img_data["image"] = updated_image
-                img_data["edited_image"] = updated_image.copy()
 
-            original_width, original_height = img_data["image"].size
+            resize_factor = self.resize_factor.get()
+            original_key = (img_data["key"], "original", img_data["original_version"], resize_factor)
+            edited_key = (img_data["key"], "edited", img_data["version"], resize_factor)
+
+            def original_box(box):
+                return self.preview_cache.get(original_key + (box,), lambda: self.render_preview(self.store.original(img_data), box, resize_factor))
 
-            # Calculate 4 times the original dimensions
-            new_width = original_width * self.resize_factor.get()  # Use .get() to retrieve value from IntVar
-            new_height = original_height * self.resize_factor.get()  # Use .get() to retrieve value from IntVar
+            def edited_box(box):
+                return self.preview_cache.get(edited_key + (box,), lambda: self.render_preview(self.store.edited(img_data), box, resize_factor))
 
             # Update Original Image Preview
-            original_resized = img_data["image"].resize((new_width, new_height), Image.Resampling.NEAREST)
-            original_preview = ImageTk.PhotoImage(original_resized)
-            self.original_preview.image = original_preview
-            self.original_preview.config(image=original_preview)
-
-            # Update Edited Image Preview
-            edited_resized = img_data["edited_image"].resize((new_width, new_height), Image.Resampling.NEAREST)
-            edited_preview = ImageTk.PhotoImage(edited_resized)
-            self.edited_preview.image = edited_preview
-            self.edited_preview.config(image=edited_preview)
+            self.original_preview.show(img_data["size"], resize_factor, original_box)
+
+            # Update Edited Image Preview, which shares the original preview while nothing is mapped
+            if not img_data["mapping"]:
+                self.edited_preview.show(img_data["size"], resize_factor, original_box)
+            elif self.is_rendering(img_data):
+                self.edited_preview.clear()  # Still rendering; refreshed when the remap job finishes
+            else:
+                self.edited_preview.show(img_data["size"], resize_factor, edited_box)
         else:
-            self.original_preview.config(image="")
-            self.edited_preview.config(image="")
+            self.original_preview.clear()
+            self.edited_preview.clear()
+
+    def render_preview(self, image, box, resize_factor):
+        # Scale only the visible box of the image
+        new_width = (box[2] - box[0]) * resize_factor
+        new_height = (box[3] - box[1]) * resize_factor
+        profiler.add(pixels=new_width * new_height)
+        return ImageTk.PhotoImage(image.resize((new_width, new_height), Image.Resampling.NEAREST, box=box))
 
+    @profiler.span("update_colors_listbox")
     def update_colors_listbox(self):
         if "edit_all_colors" in self.open_toplevels:
             self.open_toplevels["edit_all_colors_update"]()
             
-        self.colors_listbox.delete(0, tk.END)
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
-            unique_colors = img_data["image"].getcolors(maxcolors=99999)
-            if unique_colors:
-                for count, color in unique_colors:
-                    # Check if the alpha value is not 0
-                    if color[3] != 0:
-                        original_color = color
-                        edited_color = img_data["colors"].get(color, color)
-                        self.colors_listbox.insert(tk.END, f"{original_color} - {edited_color}")
+            # Skip colors whose alpha value is 0
+            colors = [color for count, color in img_data["histogram"] if color[3] != 0]
+            self.colors_listbox.set_colors(colors, img_data["colors"].matches(colors))
+        else:
+            self.colors_listbox.clear()
     
     def reset_changes(self):
         selected_indices = self.image_listbox.curselection()
         if not selected_indices:
             return
 
+        edit = self.history.new_edit()
         for index in selected_indices:
             img_data = self.images[index]
-            img_data["edited_image"] = img_data["image"].copy()  # Reset edited image to original image
-            img_data["colors"].clear()  # Clear any color modifications
+            self.record_mapping(edit, [img_data], lambda: self.store.reset(img_data))  # Reset edited image to original image
+            self.clear_color_entries(edit, img_data["colors"])  # Clear any color modifications
 
+        self.clear_color_entries(edit, self.custom_colors)
+        self.commit_edit(edit)
         self.update_previews()  # Refresh the image previews
         self.update_colors_listbox()  # Refresh the colors list
-        self.custom_colors.clear()
         if len(self.images) == 1:
             messagebox.showinfo("Reset Successful", f"Changes have been reset for {self.num_to_words(len(self.images))} image.")
         else:
@@ -273,14 +862,16 @@ class ImageEditorApp:
         if not self.images:
             return
         
+        edit = self.history.new_edit()
         for img_data in self.images:
-            img_data["edited_image"] = img_data["image"].copy()  # Reset edited image to original
-            img_data["colors"].clear()  # Clear any color modifications
+            self.record_mapping(edit, [img_data], lambda: self.store.reset(img_data))  # Reset edited image to original
+            self.clear_color_entries(edit, img_data["colors"])  # Clear any color modifications
 
         # Update the UI to reflect the changes
+        self.clear_color_entries(edit, self.custom_colors)
+        self.commit_edit(edit)
         self.update_previews()
         self.update_colors_listbox()
-        self.custom_colors.clear()
 
         messagebox.showinfo("Success", "All changes have been reset.")
 
@@ -289,19 +880,7 @@ class ImageEditorApp:
         if not selected_index:
             return
 
-        color_line = self.colors_listbox.get(selected_index[0])
-
-        try:
-            original_color_str = color_line.split(" - ")[1]
-            original_color = tuple(map(int, original_color_str.strip("()").split(",")))
-
-            if len(original_color) == 3:
-                original_color = original_color + (255,)
-            elif len(original_color) != 4:
-                raise ValueError("Invalid color format")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to parse color: {e}")
-            return
+        original_color = self.colors_listbox.edited_color(selected_index[0])
 
         if "edit_color" in self.open_toplevels:
             self.open_toplevels["edit_color"].focus()
@@ -310,7 +889,7 @@ class ImageEditorApp:
         toplevel = Toplevel(self.root)
         self.open_toplevels["edit_color"] = toplevel
         toplevel.title("Edit Color")
-        toplevel.geometry("200x200")
+        toplevel.geometry("200x235")
         toplevel.resizable(False, False)
 
         def on_close():
@@ -336,6 +915,12 @@ class ImageEditorApp:
         tk.Label(toplevel, text="Alpha:").grid(row=4, column=0, sticky="e", pady=5)
         tk.Spinbox(toplevel, from_=0, to=255, textvariable=alpha_var, width=5).grid(row=4, column=1, sticky="w", pady=5)
 
+        # Colors within this distance of the original color (largest per-channel difference) change too
+        tolerance_var = tk.IntVar(value=self.custom_colors.tolerance(original_color))
+        tk.Label(toplevel, text="Tolerance:").grid(row=5, column=0, sticky="e", pady=5)
+        tk.Spinbox(toplevel, from_=0, to=255, textvariable=tolerance_var, width=5).grid(row=5, column=1, sticky="w", pady=5)
+
+        @profiler.span("edit_color.apply_color_changes")
         def apply_color_changes():
             new_color = (red_var.get(), green_var.get(), blue_var.get(), alpha_var.get())
 
@@ -343,35 +928,27 @@ class ImageEditorApp:
                 img_data = self.images[self.selected_image_index]
 
                 # Retrieve the true original color from custom_colors if new_color already exists
-                true_original_color = next(
-                    (key for key, value in self.custom_colors.items() if value == new_color),
-                    original_color
-                )
+                true_original_color = self.custom_colors.source_for(new_color, original_color)
+                tolerance = tolerance_var.get()
+                previous_tolerance = self.custom_colors.tolerance(true_original_color)
+
+                if true_original_color != new_color or tolerance or previous_tolerance:
+                    edit = self.history.new_edit()
 
-                if true_original_color != new_color:
                     # Update the global custom_colors mapping
-                    self.custom_colors[true_original_color] = new_color
+                    self.set_color_entry(edit, self.custom_colors, true_original_color, new_color, tolerance)
 
                     # Update the mapping for the original color in the specific image
-                    img_data["colors"][true_original_color] = new_color
+                    self.set_color_entry(edit, img_data["colors"], true_original_color, new_color, tolerance)
 
                     # Reapply all custom colors for the specific image
-                    original_image = img_data["image"].copy()
-                    pixels = original_image.load()
-
-                    # Apply custom color mappings to the original image
-                    for y in range(original_image.height):
-                        for x in range(original_image.width):
-                            current_pixel = pixels[x, y]
-                            if current_pixel in self.custom_colors:
-                                pixels[x, y] = self.custom_colors[current_pixel]
-
-                    img_data["edited_image"] = original_image
+                    self.record_mapping(edit, [img_data], lambda: self.apply_mapping(img_data, self.custom_colors))
+                    self.commit_edit(edit)
                     self.update_previews()
                     self.update_colors_listbox()
                     on_close()
 
-        tk.Button(toplevel, text="Apply", command=apply_color_changes).grid(row=5, column=0, columnspan=2, pady=10)
+        tk.Button(toplevel, text="Apply", command=apply_color_changes).grid(row=6, column=0, columnspan=2, pady=10)
 
     def edit_all_colors(self, event=None):
         if len(self.images) == 0:
@@ -393,28 +970,13 @@ class ImageEditorApp:
         toplevel.protocol("WM_DELETE_WINDOW", on_close)
 
         # Listbox to display colors
-        all_colors_listbox = tk.Listbox(toplevel, selectmode=tk.SINGLE, width=40)
+        all_colors_listbox = ColorList(toplevel, width=40)
         all_colors_listbox.pack(pady=10, fill=tk.BOTH, expand=True)
 
-        # Function to get all unique colors from all images
-        def get_all_unique_colors():
-            all_colors = set()
-            for img_data in self.images:
-                unique_colors = img_data["image"].getcolors(maxcolors=99999)
-                if unique_colors:
-                    for count, color in unique_colors:
-                        if color[3] != 0:  # Exclude fully transparent colors
-                            all_colors.add(color)
-            return sorted(all_colors, key=lambda c: (c[0], c[1], c[2], c[3]))
-
         # Function to update the listbox dynamically
         def update_all_colors_listbox():
-            all_colors_listbox.delete(0, tk.END)
-            for color in get_all_unique_colors():
-                edited_color = color
-                if color in self.custom_colors:
-                    edited_color = self.custom_colors[color]
-                all_colors_listbox.insert(tk.END, f"{color} - {edited_color}")
+            colors = self.get_all_unique_colors()
+            all_colors_listbox.set_colors(colors, self.custom_colors.matches(colors))
 
         # Populate the listbox initially
         update_all_colors_listbox()
@@ -427,15 +989,14 @@ class ImageEditorApp:
             if not selected_index:
                 return
 
-            color_str = all_colors_listbox.get(selected_index[0]).split(" - ")[1]
-            original_color = tuple(map(int, color_str.strip("()").split(",")))
+            original_color = all_colors_listbox.edited_color(selected_index[0])
 
             # Open color edit window
             self.edit_color_for_all(original_color, update_all_colors_listbox)
 
         edit_button = tk.Button(toplevel, text="Edit Selected Color", command=edit_color_from_all_colors)
         edit_button.pack(pady=5)
-        all_colors_listbox.bind("<Double-1>", edit_color_from_all_colors)
+        all_colors_listbox.bind_rows("<Double-1>", edit_color_from_all_colors)
 
     def edit_color_for_all(self, original_color, update_all_colors_listbox):
         if "edit_color_for_all" in self.open_toplevels:
@@ -445,7 +1006,7 @@ class ImageEditorApp:
         toplevel = Toplevel(self.root)
         self.open_toplevels["edit_color_for_all"] = toplevel
         toplevel.title("Edit Color")
-        toplevel.geometry("200x200")
+        toplevel.geometry("200x235")
         toplevel.resizable(False, False)
 
         def on_close():
@@ -471,44 +1032,48 @@ class ImageEditorApp:
         tk.Label(toplevel, text="Alpha:").grid(row=4, column=0, sticky="e", pady=5)
         tk.Spinbox(toplevel, from_=0, to=255, textvariable=alpha_var, width=5).grid(row=4, column=1, sticky="w", pady=5)
 
+        # Colors within this distance of the original color (largest per-channel difference) change too
+        tolerance_var = tk.IntVar(value=self.custom_colors.tolerance(original_color))
+        tk.Label(toplevel, text="Tolerance:").grid(row=5, column=0, sticky="e", pady=5)
+        tk.Spinbox(toplevel, from_=0, to=255, textvariable=tolerance_var, width=5).grid(row=5, column=1, sticky="w", pady=5)
+
+        @profiler.span("edit_color_for_all.apply_color_changes")
         def apply_color_changes():
             new_color = (red_var.get(), green_var.get(), blue_var.get(), alpha_var.get())
+            tolerance = tolerance_var.get()
+            previous_tolerance = self.custom_colors.tolerance(original_color)
 
-            if original_color != new_color:
+            if original_color != new_color or tolerance or previous_tolerance:
                 # Update the custom_colors dictionary
-                self.custom_colors[original_color] = new_color
+                edit = self.history.new_edit()
+                self.set_color_entry(edit, self.custom_colors, original_color, new_color, tolerance)
 
-                for img_data in self.images:
-                    original_image = img_data["image"].copy()
-                    pixels = original_image.load()
+                # Only images that contain the changed color need to be re-rendered; with a
+                # tolerance, images holding only nearby colors are affected as well
+                affected = [
+                    img_data for img_data in self.images
+                    if tolerance or previous_tolerance or original_color in img_data["color_index"]
+                ]
 
-                    # Apply custom color mappings to the original image
-                    for y in range(original_image.height):
-                        for x in range(original_image.width):
-                            current_pixel = pixels[x, y]
-                            if current_pixel in self.custom_colors:
-                                pixels[x, y] = self.custom_colors[current_pixel]
+                # Apply custom color mappings to the original images; previews update as each one finishes
+                self.record_mapping(edit, affected, lambda: self.apply_mapping_all(affected, self.custom_colors))
 
-                    img_data["edited_image"] = original_image
+                self.commit_edit(edit)
 
             self.update_previews()
             self.update_colors_listbox()
             update_all_colors_listbox()
             on_close()
 
-        tk.Button(toplevel, text="Apply", command=apply_color_changes).grid(row=5, column=0, columnspan=2, pady=10)
+        tk.Button(toplevel, text="Apply", command=apply_color_changes).grid(row=6, column=0, columnspan=2, pady=10)
 
+    @profiler.span("save_image")
     def save_image(self):
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
             img_path = img_data["path"]
-            img_data["edited_image"].save(img_path)
-            img_data["colors"] = {}  # Reset color changes after save
-
-            # Reload the saved image
-            saved_image = Image.open(img_path).convert("RGBA")
-            img_data["image"] = saved_image
-            img_data["edited_image"] = saved_image.copy()
+            self.save_edited_image(img_data, img_path)
+            img_data["colors"] = ColorMapping()  # Reset color changes after save
 
             self.custom_colors.clear()
 
@@ -517,6 +1082,7 @@ class ImageEditorApp:
             self.update_previews()
             messagebox.showinfo("Success", f"{img_path} saved successfully.")
 
+    @profiler.span("save_image_as")
     def save_image_as(self):
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
@@ -525,13 +1091,8 @@ class ImageEditorApp:
             new_img_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg;*.jpeg"), ("All files", "*.*")])
             
             if new_img_path:  # User canceled the dialog
-                img_data["edited_image"].save(new_img_path)
-            
-                # Update the image path and reload the image
-                img_data["path"] = new_img_path
-                saved_image = Image.open(new_img_path).convert("RGBA")
-                img_data["image"] = saved_image
-                img_data["edited_image"] = saved_image.copy()
+                # Save and update the image path; lossy formats are reloaded from disk
+                self.save_edited_image(img_data, new_img_path)
 
                 # Clear any custom color modifications
                 self.custom_colors.clear()
@@ -543,50 +1104,135 @@ class ImageEditorApp:
 
                 messagebox.showinfo("Success", f"Image saved as {filename(new_img_path)}.")
     
+    @profiler.span("save_all_images")
     def save_all_images(self):
-        for img_data in self.images:
-            img_data["edited_image"].save(img_data["path"])
+        if len(self.images) == 0:
+            return
+
+        # Only images whose pixels were actually changed by a mapping get written
+        pending = [img_data for img_data in self.images if self.store.is_dirty(img_data)]
+        if not pending:
+            messagebox.showinfo("Nothing to Save", "None of the images have changes to save.")
+            return
 
-            # Reload each saved image
-            saved_image = Image.open(img_data["path"]).convert("RGBA")
-            img_data["image"] = saved_image
-            img_data["edited_image"] = saved_image.copy()
+        if "save_all_images" in self.open_toplevels:
+            self.open_toplevels["save_all_images"].focus()
+            return
 
-        for img_data in self.images:
-            img_data["colors"] = {}
-        
-        self.custom_colors.clear()
+        # PNG encoding releases the GIL, so files are written on a thread pool while Tk keeps running
+        workers = os.cpu_count() or 1
+        executor = ThreadPoolExecutor(max_workers=workers)
+        total = len(pending)
+        in_flight = {}  # Future -> image data being written
+        saved_count = 0
+        failures = []
+        cancelled = False
 
-        self.update_image_listbox()
-        self.update_colors_listbox()
-        self.update_previews()
+        toplevel = Toplevel(self.root)
+        self.open_toplevels["save_all_images"] = toplevel
+        toplevel.title("Saving Images")
+        toplevel.geometry("400x300")
+        toplevel.resizable(False, False)
+        toplevel.grab_set()  # Block edits to the images while they are being written
 
-        if len(self.images) == 1:
-            messagebox.showinfo("Success", f"One image has been saved.")
-        else:
-            messagebox.showinfo("Success", f"{self.num_to_words(len(self.images)).capitalize()} images have been saved.")
+        progress = ttk.Progressbar(toplevel, maximum=total, length=360)
+        progress.pack(pady=10)
+
+        status_label = tk.Label(toplevel, text=f"Saved 0 of {total}")
+        status_label.pack()
+
+        status_listbox = tk.Listbox(toplevel, width=60)
+        status_listbox.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+
+        def cancel():
+            nonlocal cancelled
+            cancelled = True
+            pending.clear()
+            cancel_button.config(state=tk.DISABLED)
+
+        cancel_button = tk.Button(toplevel, text="Cancel", command=cancel)
+        cancel_button.pack(pady=5)
+        toplevel.protocol("WM_DELETE_WINDOW", cancel)
+
+        def report_failure(img_data, e):
+            # Failures are collected per file and listed once saving is finished
+            name = filename(img_data["path"])
+            failures.append(f"{name}: {e}")
+            status_listbox.insert(tk.END, f"{name} - failed ({e})")
+            status_listbox.see(tk.END)
+
+        def submit_pending():
+            # Keep only a few images in flight so edited buffers are not all materialized at once.
+            # Decoding and rendering happen in the save work, off the Tk thread.
+            while pending and len(in_flight) < workers * 2:
+                img_data = pending.pop(0)
+                try:
+                    save = self.prepare_save(img_data, img_data["path"])
+                except Exception as e:
+                    report_failure(img_data, e)
+                else:
+                    in_flight[executor.submit(save)] = img_data
+
+        def poll():
+            nonlocal saved_count
+            for future in [future for future in in_flight if future.done()]:
+                img_data = in_flight.pop(future)
+                try:
+                    digest, output_image = future.result()
+                    self.promote_saved_image(img_data, img_data["path"], output_image, digest)
+                except Exception as e:
+                    report_failure(img_data, e)
+                else:
+                    img_data["colors"] = ColorMapping()
+                    saved_count += 1
+                    status_listbox.insert(tk.END, f"{filename(img_data['path'])} - saved")
+                    status_listbox.see(tk.END)
+
+            progress["value"] = saved_count + len(failures)
+            status_label.config(text=f"Saved {saved_count} of {total}")
+
+            submit_pending()
+            if in_flight:
+                toplevel.after(50, poll)
+            else:
+                finish()
+
+        def finish():
+            executor.shutdown()
+            if self.result_cache is not None:
+                self.jobs.submit(("evict_result_cache",), self.result_cache.evict, lambda result: None)
+            del self.open_toplevels["save_all_images"]
+            toplevel.grab_release()
+            toplevel.destroy()
+
+            # Unsaved images keep their edits, so the mapping is only dropped once everything is written
+            if not any(self.store.is_dirty(img_data) for img_data in self.images):
+                self.custom_colors.clear()
+
+            self.update_image_listbox()
+            self.update_colors_listbox()
+            self.update_previews()
+
+            if failures:
+                messagebox.showerror("Error", f"{saved_count} of {total} images saved. Failed to save:\n" + "\n".join(failures))
+            elif cancelled:
+                messagebox.showinfo("Cancelled", f"Saving was cancelled after {saved_count} of {total} images.")
+            elif saved_count == 1:
+                messagebox.showinfo("Success", f"One image has been saved.")
+            else:
+                messagebox.showinfo("Success", f"{self.num_to_words(saved_count).capitalize()} images have been saved.")
+
+        submit_pending()
+        toplevel.after(50, poll)
     
     def on_original_preview_click(self, event):
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
-            original_image = img_data["image"]
-            
-            # Get the dimensions of the displayed image and the original image
-            displayed_width = self.original_preview.winfo_width()
-            displayed_height = self.original_preview.winfo_height()
-            original_width, original_height = original_image.size
-            
-            # Calculate the scaling factor
-            scale_x = original_width / displayed_width
-            scale_y = original_height / displayed_height
-            
-            # Get the pixel coordinates on the original image
-            original_x = int(event.x * scale_x)
-            original_y = int(event.y * scale_y)
-            
-            # Ensure the coordinates are within bounds
-            if 0 <= original_x < original_width and 0 <= original_y < original_height:
-                pixel_color = original_image.getpixel((original_x, original_y))
+
+            # Map the click through the viewport scroll position and zoom to a pixel of the image
+            point = self.original_preview.image_point(event)
+            if point is not None:
+                pixel_color = self.store.original(img_data).getpixel(point)
                 if pixel_color[3] == 0:
                     return
                 messagebox.showinfo("Pixel Color", f"Color: {pixel_color}")
@@ -594,29 +1240,25 @@ class ImageEditorApp:
     def on_edited_preview_click(self, event):
         if self.selected_image_index is not None and len(self.images) != 0:
             img_data = self.images[self.selected_image_index]
-            edited_image = img_data["edited_image"]
-            
-            # Get the dimensions of the displayed image and the edited image
-            displayed_width = self.edited_preview.winfo_width()
-            displayed_height = self.edited_preview.winfo_height()
-            edited_width, edited_height = edited_image.size
-            
-            # Calculate the scaling factor
-            scale_x = edited_width / displayed_width
-            scale_y = edited_height / displayed_height
-            
-            # Get the pixel coordinates on the edited image
-            edited_x = int(event.x * scale_x)
-            edited_y = int(event.y * scale_y)
-            
-            # Ensure the coordinates are within bounds
-            if 0 <= edited_x < edited_width and 0 <= edited_y < edited_height:
-                pixel_color = edited_image.getpixel((edited_x, edited_y))
+
+            # Map the click through the viewport scroll position and zoom to a pixel of the image
+            point = self.edited_preview.image_point(event)
+            if point is not None:
+                pixel_color = self.store.edited(img_data).getpixel(point)
                 if pixel_color[3] == 0:
                     return
                 messagebox.showinfo("Pixel Color", f"Color: {pixel_color}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Edit the colors of multiple images at once.")
+    parser.add_argument("--trace", help=f"Write a Chrome trace of the session to this file (or set {TRACE_ENV})")
+    parser.add_argument("--cprofile", help=f"Write a cProfile capture of the session to this file (or set {CPROFILE_ENV})")
+    args = parser.parse_args()
+    if args.trace or args.cprofile:
+        profiler.enable(args.trace, args.cprofile)
+    else:
+        profiler.enable_from_env()
+
     root = tk.Tk()
     app = ImageEditorApp(root)
     root.mainloop()
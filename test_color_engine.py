@@ -0,0 +1,301 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from color_engine import (
+    ColorMapping, ResultCache, copy_duplicate, file_digest, image_histogram, open_image, pack_color, pack_colors,
+    pack_pixels, png_stream_header, read_png_strips, remap_batch, remap_file, remap_file_tiled, remap_image, remap_indexed, save_remapped_tiled, unpack_color,
+    write_png_strips
+)
+
+
+def brute_force_match(entries, color):
+    # Reference for ColorMapping.match: an exact source wins, otherwise the nearest tolerance entry by
+    # largest per-channel difference, earlier entries winning ties
+    for source, target, tolerance in entries:
+        if source == color:
+            return target
+    best = None
+    for source, target, tolerance in entries:
+        distance = max(abs(a - b) for a, b in zip(source, color))
+        if tolerance and distance <= tolerance and (best is None or distance < best[0]):
+            best = (distance, target)
+    return None if best is None else best[1]
+
+
+def make_mapping(entries):
+    mapping = ColorMapping()
+    for source, target, tolerance in entries:
+        mapping[source] = target
+        mapping.set_tolerance(source, tolerance)
+    return mapping
+
+
+def test_match_tries_other_entries_when_alpha_rules_out_the_nearest():
+    entries = [((100, 100, 100, 255), (1, 1, 1, 255), 10), ((103, 100, 100, 200), (2, 2, 2, 255), 10)]
+    mapping = make_mapping(entries)
+    assert mapping.match((101, 100, 100, 200)) == (2, 2, 2, 255)
+    assert mapping.match((101, 100, 100, 255)) == (1, 1, 1, 255)
+    assert mapping.match((120, 100, 100, 255)) is None
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_tolerance_lookup_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # Sources packed close together, so tolerance cubes overlap and alpha decides between them
+    sources = {tuple(int(channel) for channel in color) for color in rng.integers(90, 120, size=(12, 4))}
+    entries = [
+        (source, tuple(int(channel) for channel in rng.integers(0, 256, 4)), int(rng.choice([0, 3, 8, 15])))
+        for source in sorted(sources)
+    ]
+    mapping = make_mapping(entries)
+
+    colors = [tuple(int(channel) for channel in color) for color in rng.integers(80, 130, size=(2000, 4))]
+    colors += [source for source, target, tolerance in entries]
+    expected = [brute_force_match(entries, color) for color in colors]
+    assert mapping.matches(colors, [None] * len(colors)) == expected
+    assert mapping.arrays is None  # Short color lists are matched without building the tolerance table
+    mapping.lookup()
+    assert mapping.matches(colors, [None] * len(colors)) == expected
+
+
+def test_restricted_resolves_tolerances_like_match():
+    entries = [((10, 10, 10, 255), (0, 0, 0, 255), 5), ((14, 10, 10, 240), (9, 9, 9, 255), 5)]
+    mapping = make_mapping(entries)
+    colors = {(12, 10, 10, 250), (12, 10, 10, 240), (40, 40, 40, 255)}
+    restricted = mapping.restricted(colors)
+    assert dict(restricted.items()) == {color: mapping.match(color) for color in colors if mapping.match(color) is not None}
+    assert not restricted.tolerances
+    assert mapping.restricted(pack_colors(colors)) == restricted
+
+
+@pytest.mark.parametrize("tolerance", [0, 6])
+def test_restricted_by_packed_colors_matches_color_sets(tolerance):
+    rng = np.random.default_rng(tolerance)
+    sources = [tuple(int(channel) for channel in color) for color in rng.integers(0, 8, size=(40, 4)) * 16]
+    mapping = make_mapping([(source, (1, 2, 3, 4), tolerance) for source in dict.fromkeys(sources)])
+    colors = {tuple(int(channel) for channel in color) for color in rng.integers(0, 128, size=(3000, 4))} | set(sources[:10])
+    assert mapping.restricted(pack_colors(colors)) == mapping.restricted(frozenset(colors))
+
+
+def random_image(rng, size, colors=8):
+    # Pixels drawn from a small palette, so random mappings hit a good share of them
+    palette = rng.integers(0, 256, size=(colors, 4), dtype=np.uint8)
+    return Image.fromarray(palette[rng.integers(0, colors, size=(size[1], size[0]))], "RGBA")
+
+
+def pixel_colors(image):
+    return [tuple(pixel) for pixel in np.asarray(image.convert("RGBA")).reshape(-1, 4).tolist()]
+
+
+def random_entries(rng, image, tolerance=0):
+    colors = [color for count, color in image.getcolors()]
+    sources = [colors[position] for position in rng.permutation(len(colors))[:len(colors) // 2]]
+    sources.append((1, 2, 3, 4))  # An entry no pixel has
+    return [(source, tuple(int(channel) for channel in rng.integers(0, 256, 4)), tolerance) for source in sources]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_remap_image_matches_a_per_pixel_loop(seed):
+    rng = np.random.default_rng(seed)
+    image = random_image(rng, (23, 17))
+    entries = random_entries(rng, image)
+    reference = {source: target for source, target, tolerance in entries}
+    expected = [reference.get(color, color) for color in pixel_colors(image)]
+    assert pixel_colors(remap_image(image, make_mapping(entries))) == expected
+    assert pixel_colors(remap_image(image, reference)) == expected
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_remap_image_with_tolerances_matches_a_per_pixel_loop(seed):
+    rng = np.random.default_rng(seed)
+    image = random_image(rng, (23, 17), colors=40)
+    entries = random_entries(rng, image, tolerance=int(rng.integers(1, 60)))
+    expected = []
+    for color in pixel_colors(image):
+        target = brute_force_match(entries, color)
+        expected.append(color if target is None else target)
+    assert pixel_colors(remap_image(image, make_mapping(entries))) == expected
+
+
+@pytest.mark.parametrize("transparency", [None, "index", "alphas"])
+def test_remap_indexed_matches_the_rgba_path(tmp_path, transparency):
+    rng = np.random.default_rng(3)
+    image = Image.fromarray(rng.integers(0, 12, size=(19, 21), dtype=np.uint8), "P")
+    image.putpalette(rng.integers(0, 256, 16 * 3, dtype=np.uint8).tobytes())
+    if transparency == "index":
+        image.info["transparency"] = 5
+    elif transparency == "alphas":
+        image.info["transparency"] = rng.integers(0, 256, 10, dtype=np.uint8).tobytes()
+    image.save(tmp_path / "in.png")
+    image = open_image(str(tmp_path / "in.png"))
+    assert image.mode == "P"
+
+    rgba = image.convert("RGBA")
+    for tolerance in (0, 30):
+        mapping = make_mapping(random_entries(rng, rgba, tolerance))
+        expected = pixel_colors(remap_image(rgba, mapping))
+        remapped = remap_indexed(image, mapping)
+        assert pixel_colors(remapped) == expected
+        remapped.save(tmp_path / "out.png")
+        assert pixel_colors(Image.open(tmp_path / "out.png")) == expected
+
+
+@pytest.mark.parametrize("tolerance", [0, 25])
+def test_remap_batch_matches_remap_image(tolerance):
+    rng = np.random.default_rng(tolerance)
+    images = [random_image(rng, (int(rng.integers(1, 40)), int(rng.integers(1, 40))), colors=20) for _ in range(30)]
+    mapping = make_mapping(random_entries(rng, images[0], tolerance))
+    untouched = next(color for color in ((value, value, value, value) for value in range(256)) if mapping.match(color) is None)
+    images.append(Image.new("RGBA", (5, 3), untouched))
+
+    remapped = remap_batch(images, mapping)
+    assert len(remapped) == len(images)
+    for image, new_image in zip(images, remapped):
+        assert new_image.size == image.size
+        assert new_image.tobytes() == remap_image(image, mapping).tobytes()
+    assert remapped[-1] is images[-1]
+
+
+def test_packed_colors_round_trip():
+    for color in [(0, 0, 0, 0), (255, 255, 255, 255), (1, 2, 3, 4)]:
+        assert unpack_color(pack_color(color)) == color
+
+
+def sprite(size, mode="RGBA", seed=0):
+    # Palette noise over a gradient, so the encoder picks different row filters
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, size=(6, 4), dtype=np.uint8)
+    pixels = palette[rng.integers(0, 6, size=(size[1], size[0]))]
+    pixels[: size[1] // 2, :, 0] = np.arange(size[0]) % 256
+    return Image.fromarray(pixels if mode == "RGBA" else pixels[:, :, :3].copy(), mode)
+
+
+@pytest.mark.parametrize("rows", [1, 7, 256])
+def test_write_png_strips_round_trips(tmp_path, rows):
+    image = sprite((53, 40))
+    pixels = pack_pixels(image)
+    path = tmp_path / "out.png"
+    write_png_strips(path, image.size, (pixels[top * 53:(top + rows) * 53] for top in range(0, 40, rows)))
+    assert Image.open(path).tobytes() == image.tobytes()
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB"])
+@pytest.mark.parametrize("rows", [1, 5, 256])
+def test_read_png_strips_matches_pillow(tmp_path, mode, rows):
+    path = tmp_path / "in.png"
+    sprite((37, 61), mode).save(path, compress_level=1)
+    assert png_stream_header(path) == (37, 61, mode)
+    strips = list(read_png_strips(path, rows))
+    assert len(strips) == -(-61 // rows)
+    assert np.concatenate(strips).tobytes() == open_image(path).tobytes()
+
+
+def test_png_stream_header_rejects_other_pngs(tmp_path):
+    Image.new("P", (4, 4)).save(tmp_path / "palette.png")
+    Image.new("RGB", (4, 4)).save(tmp_path / "keyed.png", transparency=(0, 0, 0))
+    Image.new("I;16", (4, 4)).save(tmp_path / "deep.png")
+    for name in ("palette.png", "keyed.png", "deep.png"):
+        assert png_stream_header(tmp_path / name) is None
+
+
+def test_tiled_remaps_match_remap_image(tmp_path):
+    image = sprite((64, 50))
+    color = image.getpixel((63, 49))
+    mapping = ColorMapping({color: (1, 2, 3, 255)})
+    mapping.set_tolerance(color, 2)
+    expected = remap_image(image, mapping).tobytes()
+
+    image.save(tmp_path / "in.png")
+    save_remapped_tiled(image, mapping, tmp_path / "saved.png", rows=16)
+    assert Image.open(tmp_path / "saved.png").tobytes() == expected
+    assert remap_file_tiled(str(tmp_path / "in.png"), str(tmp_path / "streamed.png"), mapping, rows=16) == "written"
+    assert Image.open(tmp_path / "streamed.png").tobytes() == expected
+    assert remap_file_tiled(str(tmp_path / "in.png"), str(tmp_path / "clean.png"), ColorMapping({(7, 7, 7, 7): (0, 0, 0, 0)})) == "copied"
+
+
+def test_cache_key_matches_the_app_key(tmp_path):
+    # The app keys a save by the mapping restricted to the image's colors; remap_file must agree
+    cache = ResultCache(str(tmp_path / "cache"))
+    Image.new("RGBA", (8, 8), (10, 20, 30, 255)).save(tmp_path / "in.png")
+    mapping = ColorMapping({(10, 20, 30, 255): (1, 2, 3, 255), (99, 99, 99, 255): (0, 0, 0, 255)})
+
+    image = open_image(str(tmp_path / "in.png"))
+    colors = frozenset(color for count, color in image_histogram(image))
+    app_key = cache.key(file_digest(tmp_path / "in.png"), mapping.restricted(colors), "out.png")
+    assert not os.path.exists(cache.entry_path(app_key))
+
+    assert remap_file(str(tmp_path / "in.png"), str(tmp_path / "out.png"), mapping, cache=cache) == "written"
+    assert os.path.exists(cache.entry_path(app_key))
+    assert remap_file(str(tmp_path / "in.png"), str(tmp_path / "again.png"), mapping, cache=cache) == "cached"
+    assert (tmp_path / "again.png").read_bytes() == (tmp_path / "out.png").read_bytes()
+
+
+def test_copies_never_write_through_linked_cache_entries(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), link=True)
+    source = str(tmp_path / "a.png")
+    Image.new("RGBA", (8, 8), (10, 20, 30, 255)).save(source)
+    mapping = ColorMapping({(10, 20, 30, 255): (1, 2, 3, 255)})
+    for name in ("out", "out2", "out3", "out4"):
+        os.makedirs(tmp_path / name)
+
+    assert remap_file(source, str(tmp_path / "out" / "a.png"), mapping, cache=cache) == "written"
+    assert remap_file(source, str(tmp_path / "out2" / "a.png"), mapping, cache=cache) == "cached"
+    assert os.stat(tmp_path / "out2" / "a.png").st_nlink > 1
+
+    # A mapping that leaves the file alone copies the source over the linked output
+    assert remap_file(source, str(tmp_path / "out2" / "a.png"), ColorMapping({(9, 9, 9, 255): (0, 0, 0, 255)}), cache=cache) == "copied"
+    assert remap_file(source, str(tmp_path / "out3" / "a.png"), mapping, cache=cache) == "cached"
+    assert Image.open(tmp_path / "out3" / "a.png").getpixel((0, 0)) == (1, 2, 3, 255)
+
+    # Duplicates get the first copy's output, also over an output linked into the cache
+    assert remap_file(source, str(tmp_path / "out4" / "a.png"), mapping, cache=cache) == "cached"
+    (tmp_path / "other.png").write_bytes(b"other output")
+    assert copy_duplicate("written", str(tmp_path / "other.png"), source, str(tmp_path / "out4" / "a.png")) == "duplicate"
+    assert Image.open(tmp_path / "out3" / "a.png").getpixel((0, 0)) == (1, 2, 3, 255)
+    assert remap_file(source, str(tmp_path / "out" / "b.png"), mapping, cache=cache) == "cached"
+    assert Image.open(tmp_path / "out" / "b.png").getpixel((0, 0)) == (1, 2, 3, 255)
+
+
+def test_cache_input_descriptions_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    assert cache.load_input("ab" * 32) is None
+    cache.store_input("ab" * 32, (3, 4), True, pack_colors({(1, 2, 3, 4), (5, 6, 7, 8)}))
+    size, indexed, colors = cache.load_input("ab" * 32)
+    assert (size, indexed) == ((3, 4), True)
+    assert colors.dtype == np.uint32 and list(map(unpack_color, colors)) == [(1, 2, 3, 4), (5, 6, 7, 8)]
+
+
+def test_cache_store_from_many_threads(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    (tmp_path / "out.png").write_bytes(os.urandom(100000))
+    errors = []
+
+    def store():
+        for _ in range(25):
+            try:
+                cache.store("cd" * 32, str(tmp_path / "out.png"))
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=store) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert cache.info() == (1, 100000)
+
+
+def test_cache_evict_keeps_the_most_recent_entries(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=250)
+    for number in range(4):
+        (tmp_path / "out.png").write_bytes(bytes(100))
+        key = f"{number:02d}" * 32
+        cache.store(key, str(tmp_path / "out.png"))
+        os.utime(cache.entry_path(key), (number, number))
+    cache.evict()
+    assert sorted(os.path.basename(entry) for entry in cache.entries()) == ["02" * 32 + ".out", "03" * 32 + ".out"]